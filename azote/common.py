@@ -25,11 +25,14 @@ screen_h = None
 lang = None             # dictionary "name": lang_string
 
 preview = None
+thumbnails_task = None  # thumbnailer.Task creating thumbnails for the current folder
+watcher = None          # watcher.Watcher following changes in the current folder, if inotify available
+tracking_timer = None   # GLib source checking the current folder periodically, if not
 progress_bar = None
 status_bar = None
-thumbnails_list = None
+thumbnails_list = None  # main.Picture objects, in the preview order
 display_boxes_list = None
-selected_wallpaper = None
+selected_wallpaper = None  # main.Picture
 selected_picture_label = None
 split_button = None
 apply_button = None
@@ -42,6 +45,9 @@ associations = None     # dictionary {'extension": [program1, program2, program3
 
 app_dir = ''            # ~/.azote
 thumb_dir = ''          # ~/.azote/thumbnails
+index = None            # index.Index: thumbnails and image metadata, in ~/.local/share/azote/thumbnails.db
+pack = None             # store.Pack: thumbnails in ~/.local/share/azote/thumbnails.pack
+writer = None           # store.Writer: stores new thumbnails in the background
 tmp_dir = ''            # ~/.azote/temp
 bcg_dir = ''            # ~/.azote/backgrounds-sway or ~/.azote/backgrounds-feh
 sample_dir = ''         # ~/.azote/sample
@@ -0,0 +1,7 @@
+"""
+GTK-free core of Azote: thumbnails, image processing, colour palettes and the index
+
+Modules here take everything they need as parameters, and touch neither Gtk nor azote.common,
+so that they import fast, and are safe to use in worker processes and command line tools.
+Optional image format plugins are only loaded when an image is first opened, see formats.py.
+"""
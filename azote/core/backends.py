@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Image decoders for the thumbnail engine: Pillow, pyvips (optional) and GdkPixbuf
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+Every backend decodes the source image straight to the thumbnail size, and returns it as PIL.Image.
+Optional libraries are only imported when a backend is first used, in the worker process.
+"""
+import io
+import math
+import importlib.util
+import struct
+import zlib
+import functools
+
+from PIL import Image, ExifTags
+
+from azote.core import formats
+
+# How much bigger than the thumbnail the image should stay, before resampling with LANCZOS
+REDUCING_GAP = 2.0
+
+# Size of data decoded at once in the memory-bounded mode
+STRIP_BYTES = 4 * 1024 * 1024
+
+# Formats which often carry a preview made by the camera or the phone
+EMBEDDED_PREVIEWS = {'jpg', 'jpeg', 'heic', 'heif', 'avif'}
+
+# Embedded previews in proportions other than the image's have black bars added
+ASPECT_TOLERANCE = 0.02
+
+# Backends to try in the 'auto' mode, the fastest first. For each file we skip those not supporting its format
+# (e.g. libvips built without libheif), so the fastest backend is chosen per format.
+PREFERENCE = ['vips', 'pillow', 'gdkpixbuf']
+
+
+def reduce_on_decode(img, thumb_size):
+    """
+    Lets the decoder skip the resolution we do not need. JPEG decodes straight at 1/2, 1/4 or 1/8 scale
+    (draft mode); anything still much bigger than the thumbnail gets cheap integer box reduction.
+    The result stays at least REDUCING_GAP times bigger than the thumbnail, for the final LANCZOS pass to look good.
+    Must be called before the pixel data gets loaded.
+    :param img: opened PIL.Image
+    :param thumb_size: (width, height) of the thumbnail
+    :return: PIL.Image
+    """
+    width, height = img.size
+    scale = min(thumb_size[0] / width, thumb_size[1] / height) * REDUCING_GAP
+    if scale >= 1:
+        return img
+    img.draft(None, (math.ceil(width * scale), math.ceil(height * scale)))
+
+    factor = int(min(img.size[0] / (width * scale), img.size[1] / (height * scale)))
+    if factor > 1:
+        img = reducible(img).reduce(factor)
+    return img
+
+
+def reducible(img):
+    """
+    Image.reduce() refuses palette and 1-bit images, and would average palette indices of PA images:
+    we convert them to modes it can reduce
+    :param img: PIL.Image
+    :return: PIL.Image in a mode Image.reduce() supports
+    """
+    if img.mode in ('P', 'PA'):
+        return img.convert('RGBA' if img.mode == 'PA' or 'transparency' in img.info else 'RGB')
+    if img.mode == '1':
+        return img.convert('L')
+    if img.mode.startswith('I;16'):
+        return img.convert('I')
+    return img
+
+
+def fit_size(size, thumb_size):
+    """
+    Size Image.thumbnail() gives: the image scaled down to fit the thumbnail, in the same proportions, with the same
+    rounding. Images which fit already keep their size: backends other than Pillow must not upscale them.
+    :param size: (width, height) of the source image
+    :param thumb_size: (width, height) of the thumbnail
+    :return: (width, height)
+    """
+    width, height = size
+    x, y = thumb_size
+    if x >= width and y >= height:
+        return width, height
+    aspect = width / height
+    if x / y >= aspect:
+        candidates = (math.floor(y * aspect), math.ceil(y * aspect))
+        x = max(min(candidates, key=lambda n: abs(aspect - n / y)), 1)
+    else:
+        candidates = (math.floor(x / aspect), math.ceil(x / aspect))
+        y = max(min(candidates, key=lambda n: 0 if n == 0 else abs(aspect - x / n)), 1)
+    return x, y
+
+
+def image_info(img):
+    """
+    Details read from the image header; pixel data does not need to be decoded
+    :param img: opened PIL.Image
+    :return: (width, height, format, EXIF orientation or None)
+    """
+    orientation = None
+    # For some formats (e.g. PNG) getexif() would load the whole image, looking for EXIF data behind pixels
+    if 'exif' in img.info:
+        try:
+            orientation = img.getexif().get(0x0112)
+        except Exception:
+            pass
+    return img.size[0], img.size[1], img.format, orientation
+
+
+def reduction_factor(size, thumb_size):
+    """
+    :return: integer factor we can reduce the image by, and still have it REDUCING_GAP times bigger than the thumbnail
+    """
+    scale = min(thumb_size[0] / size[0], thumb_size[1] / size[1]) * REDUCING_GAP
+    return max(1, int(1 / scale))
+
+
+def png_rows(fp, offset, stride):
+    """
+    Reads zlib-compressed PNG data from consecutive IDAT chunks, and decompresses it in small portions.
+    :param fp: file object
+    :param offset: position of the first IDAT chunk data
+    :param stride: length of a row (with the filter type byte)
+    :return: generator of bytes, containing whole rows
+    """
+    decompressor = zlib.decompressobj()
+    buffer = b''
+    fp.seek(offset - 8)
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type != b'IDAT':
+            break
+        remaining = length
+        while remaining:
+            data = fp.read(min(remaining, 65536))
+            if not data:
+                return
+            remaining -= len(data)
+            # Limit the output size: a flat image may decompress at 1000:1
+            while data:
+                buffer += decompressor.decompress(data, STRIP_BYTES)
+                data = decompressor.unconsumed_tail
+                whole = len(buffer) - len(buffer) % stride
+                if whole:
+                    yield buffer[:whole]
+                    buffer = buffer[whole:]
+        fp.read(4)  # CRC
+
+
+def png_strip_reduce(path, thumb_size):
+    """
+    Reduces a huge PNG image without decoding it as a whole. We decompress rows in strips of a limited size.
+    Each strip is unfiltered by Pillow's own PNG decoder: we pass it the last row of the previous strip
+    (as an unfiltered row), which the first row of the strip may refer to, and re-wrap the data in stored zlib blocks.
+    Only non-interlaced 8-bit images are supported.
+    :param path: PNG file
+    :param thumb_size: (width, height) of the thumbnail
+    :return: PIL.Image reduced by reduction_factor(), or None if the file is not supported
+    """
+    img = Image.open(path)
+    with open(path, 'rb') as fp:
+        ihdr = fp.read(29)
+    bit_depth, color_type, interlace = ihdr[24], ihdr[25], ihdr[28]
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color_type)
+    if bit_depth != 8 or interlace or not channels or img.mode not in ('L', 'LA', 'RGB', 'RGBA', 'P'):
+        return None
+
+    tile = img.tile[0]
+    width, height = img.size
+    row_bytes = width * channels
+    stride = row_bytes + 1
+    factor = reduction_factor(img.size, thumb_size)
+    # strip height in rows: a multiple of the factor, to keep reduced strips seamless
+    rows = max(factor, STRIP_BYTES // stride // factor * factor)
+
+    result = Image.new(img.mode, (math.ceil(width / factor), math.ceil(height / factor)))
+    if img.mode == 'P':
+        result.putpalette(img.getpalette())
+    y = 0
+    previous = None  # unfiltered bytes of the last row decoded
+    pending = b''
+    with open(path, 'rb') as fp:
+        for data in png_rows(fp, tile[2], stride):
+            pending += data
+            while len(pending) >= rows * stride or (pending and y + len(pending) // stride >= height):
+                count = min(rows, len(pending) // stride, height - y)
+                strip_data = pending[:count * stride]
+                pending = pending[count * stride:]
+                if previous is not None:
+                    strip_data = b'\x00' + previous + strip_data
+                strip = Image.frombytes(img.mode, (width, count + (previous is not None)),
+                                        zlib.compress(strip_data, 0), 'zip', img.mode)
+                if previous is not None:
+                    strip = strip.crop((0, 1, width, count + 1))
+                previous = strip.crop((0, count - 1, width, count)).tobytes()
+                result.paste(strip.reduce(factor) if img.mode != 'P' else strip.resize(
+                    (math.ceil(width / factor), math.ceil(count / factor)), Image.NEAREST), (0, y // factor))
+                y += count
+                if y >= height:
+                    break
+            if y >= height:
+                break
+    if y < height:
+        raise ValueError('Truncated PNG data: {} of {} rows'.format(y, height))
+    if 'transparency' in img.info:
+        result.info['transparency'] = img.info['transparency']
+    return result
+
+
+class PillowBackend(object):
+    name = 'pillow'
+    module = 'PIL'
+
+    def extensions(self):
+        formats.register()
+        return set(ext[1:].lower() for ext in Image.registered_extensions())
+
+    def thumbnail(self, path, thumb_size, max_pixels=0):
+        """
+        :param max_pixels: bigger images must be reduced in the memory-bounded mode; 0 for no limit
+        :return: (thumbnail as PIL.Image, (width, height, format, orientation) of the source image)
+        """
+        img = Image.open(path)
+        info = image_info(img)
+        if max_pixels and info[0] * info[1] > max_pixels:
+            img = self.bounded(img, path, thumb_size, max_pixels)
+        else:
+            img = reduce_on_decode(img, thumb_size)
+        # reduce_on_decode has already done what reducing_gap would do
+        img.thumbnail(thumb_size, Image.LANCZOS, reducing_gap=None)
+        return img, info
+
+    def bounded(self, img, path, thumb_size, max_pixels):
+        if img.format == 'JPEG':
+            # DCT scaling: at most 1/64 of the pixels gets decoded
+            img = reduce_on_decode(img, thumb_size)
+            if img.size[0] * img.size[1] <= max_pixels:
+                return img
+        elif img.format == 'PNG':
+            reduced = png_strip_reduce(path, thumb_size)
+            if reduced is not None:
+                return reduced
+        raise ValueError('{} x {} px exceeds max_decode_pixels, and Pillow can not decode {} partially'.format(
+            img.size[0], img.size[1], img.format))
+
+
+class VipsBackend(object):
+    """
+    libvips shrinks JPEG, WebP and HEIF on load, and streams PNG, so that memory use stays low
+    """
+    name = 'vips'
+    module = 'pyvips'
+    loaders = {'jpg': 'jpegload', 'jpeg': 'jpegload', 'png': 'pngload', 'webp': 'webpload', 'heic': 'heifload',
+               'avif': 'heifload', 'jxl': 'jxlload'}
+    formats = {'jpegload': 'JPEG', 'pngload': 'PNG', 'webpload': 'WEBP', 'heifload': 'HEIF', 'jxlload': 'JXL'}
+    modes = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+    def __init__(self):
+        import pyvips
+        self.pyvips = pyvips
+
+    def extensions(self):
+        return set(ext for ext, loader in self.loaders.items() if self.pyvips.type_find('VipsForeign', loader))
+
+    def thumbnail(self, path, thumb_size, max_pixels=0):
+        # sequential access keeps memory use bounded anyway
+        pyvips = self.pyvips
+        source = pyvips.Image.new_from_file(path, access='sequential')
+        loader = source.get('vips-loader') if source.get_typeof('vips-loader') else ''
+        orientation = source.get('orientation') if source.get_typeof('orientation') else None
+        info = (source.width, source.height, self.formats.get(loader.replace('_source', '').replace('_file', '')),
+                orientation)
+
+        # Other backends do not apply EXIF orientation either
+        width, height = fit_size((source.width, source.height), thumb_size)
+        thumb = pyvips.Image.thumbnail(path, width, height=height, size='force', no_rotate=True)
+        if thumb.interpretation not in ('srgb', 'b-w'):
+            thumb = thumb.colourspace('srgb')
+        if thumb.format != 'uchar':
+            thumb = thumb.cast('uchar')
+        img = Image.frombytes(self.modes[thumb.bands], (thumb.width, thumb.height), thumb.write_to_memory())
+        return img, info
+
+
+class GdkPixbufBackend(object):
+    """
+    Loaders installed for gdk-pixbuf may handle formats Pillow has no plugins for
+    """
+    name = 'gdkpixbuf'
+    module = 'gi'
+
+    def __init__(self):
+        import gi
+        gi.require_version('GdkPixbuf', '2.0')
+        from gi.repository import GdkPixbuf
+        self.GdkPixbuf = GdkPixbuf
+
+    def extensions(self):
+        result = set()
+        for fmt in self.GdkPixbuf.Pixbuf.get_formats():
+            result.update(ext.lower() for ext in fmt.get_extensions())
+        return result
+
+    def thumbnail(self, path, thumb_size, max_pixels=0):
+        fmt, width, height = self.GdkPixbuf.Pixbuf.get_file_info(path)
+        if max_pixels and width * height > max_pixels:
+            # most loaders decode the whole image before scaling
+            raise ValueError('{} x {} px exceeds max_decode_pixels'.format(width, height))
+        pixbuf = self.GdkPixbuf.Pixbuf.new_from_file_at_scale(path, *fit_size((width, height), thumb_size), False)
+        orientation = pixbuf.get_option('orientation')
+        info = (width, height, fmt.get_name().upper() if fmt else None, int(orientation) if orientation else None)
+
+        mode = 'RGBA' if pixbuf.get_has_alpha() else 'RGB'
+        # the last row may be shorter than rowstride, which Image.frombuffer would not accept
+        img = Image.frombytes(mode, (pixbuf.get_width(), pixbuf.get_height()), pixbuf.get_pixels(), 'raw', mode,
+                              pixbuf.get_rowstride())
+        return img, info
+
+
+def embedded_preview(path):
+    """
+    Reads the preview stored in the file: the EXIF thumbnail of JPEG, the thumbnail item of HEIF and AVIF.
+    Much cheaper than decoding the image, but small (often 160 x 120), so only good for a first draft.
+    :return: (preview as PIL.Image, (width, height, format, orientation) of the source image), or None
+    """
+    formats.register()
+    with Image.open(path) as img:
+        info = image_info(img)
+        preview = None
+        if img.format == 'JPEG' and 'exif' in img.info:
+            # IFD1 points at the JPEG thumbnail, with offsets counted from the TIFF header (after b'Exif\0\0')
+            ifd1 = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+            offset, length = ifd1.get(0x0201), ifd1.get(0x0202)
+            if offset and length:
+                data = img.info['exif'][6 + offset:6 + offset + length]
+                preview = Image.open(io.BytesIO(data))
+                preview.load()
+        elif img.format in ('HEIF', 'AVIF'):
+            try:
+                from pillow_heif import thumbnail
+            except ImportError:
+                return None
+            preview = thumbnail(img)
+            if preview is img:
+                # no thumbnail item in the file
+                return None
+            preview = preview.copy()
+    if preview is None or not preview.size[0] or not preview.size[1]:
+        return None
+    if abs(preview.size[0] / preview.size[1] - info[0] / info[1]) > ASPECT_TOLERANCE * info[0] / info[1]:
+        return None
+    return preview, info
+
+
+BACKENDS = {'pillow': PillowBackend, 'vips': VipsBackend, 'gdkpixbuf': GdkPixbufBackend}
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(name):
+    """
+    :return: backend instance, or None if its library is not installed
+    """
+    try:
+        return BACKENDS[name]()
+    except Exception:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def backend_extensions(name):
+    backend = get_backend(name)
+    if backend is None:
+        return frozenset()
+    try:
+        return frozenset(backend.extensions())
+    except Exception:
+        return frozenset()
+
+
+def available():
+    """
+    Only looks for the libraries, without importing them: the GUI process calls it, and must not start libvips
+    before the worker pool gets forked
+    :return: names of backends we can probably use
+    """
+    return [name for name, backend in BACKENDS.items() if importlib.util.find_spec(backend.module)]
+
+
+@functools.lru_cache(maxsize=None)
+def configuration(choice='auto', max_pixels=0):
+    """
+    Describes what decides whether we're able to decode a file, apart from the file itself. Failures recorded
+    under a different configuration (e.g. before installing a plugin, or raising max_decode_pixels) are worth retrying.
+    :return: string
+    """
+    return '{};{};{}'.format(choice, max_pixels, ','.join(available() + formats.installed()))
+
+
+def backends_for(path, choice='auto'):
+    """
+    Backends to try for the file, in order: the one chosen in settings goes first, others serve as fallback
+    :param path: image path
+    :param choice: 'auto' or backend name
+    :return: list of backend instances
+    """
+    ext = path.split('.')[-1].lower()
+    names = list(PREFERENCE)
+    if choice in names:
+        names.remove(choice)
+        names.insert(0, choice)
+    return [get_backend(name) for name in names if ext in backend_extensions(name)]
+
+
+def thumbnail(path, thumb_size, choice='auto', max_pixels=0):
+    """
+    Decodes the image with the first backend able to do it
+    :param max_pixels: memory use limit: bigger images must be decoded partially, or in strips; 0 for no limit
+    :return: (thumbnail as PIL.Image, (width, height, format, orientation) of the source image)
+    """
+    formats.register()
+    error = None
+    for backend in backends_for(path, choice):
+        try:
+            return backend.thumbnail(path, thumb_size, max_pixels)
+        except Exception as e:
+            error = e
+    if error:
+        raise error
+    raise ValueError('No decoder available for {}'.format(path))
@@ -14,21 +14,7 @@ import math
 
 from PIL import Image
 
-try:
-    from pillow_heif import register_heif_opener
-    register_heif_opener()
-except ImportError:
-    print('Warning: HEIF/HEIC image support not available. Install pillow-heif.')
-
-try:
-    import pillow_avif
-except ImportError:
-    print('Warning: AVIF image support not available. Install pillow-avif.')
-
-try:
-    import pillow_jxl
-except ImportError:
-    print('JPEG XL (JXL) support not available. Install pillow-jxl if needed.')
+from azote.core import formats
 
 
 class cached_property(object):
@@ -54,6 +40,7 @@ class ColorThief(object):
                      must implement `read()`, `seek()`, and `tell()` methods,
                      and be opened in binary mode.
         """
+        formats.register()
         self.image = Image.open(file)
 
     def get_color(self, quality=10):
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Optional Pillow plugins for HEIF/HEIC, AVIF and JPEG XL images
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+Importing the plugins takes longer than the rest of the core together: we only do it before opening an image.
+"""
+import importlib.util
+
+# Modules of the plugins, in the order of registration
+PLUGINS = ['pillow_heif', 'pillow_avif', 'pillow_jxl']
+
+_registered = False
+
+
+def register():
+    """
+    Makes Image.open() support formats of installed plugins. Cheap to call again.
+    """
+    global _registered
+    if _registered:
+        return
+    _registered = True
+    try:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+    except ImportError:
+        pass
+
+    try:
+        import pillow_avif
+    except ImportError:
+        pass
+
+    try:
+        import pillow_jxl
+    except ImportError:
+        pass
+
+
+def installed():
+    """
+    Looks for the plugins without importing them
+    :return: list of plugin module names
+    """
+    return [name for name in PLUGINS if importlib.util.find_spec(name)]
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Shared thumbnails, as created by file managers and image viewers in ~/.cache/thumbnails
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+See https://specifications.freedesktop.org/thumbnail-spec/latest/ - thumbnails are PNG files named after MD5 of the
+file URI, and valid as long as their Thumb::MTime matches the file. Used in worker processes: must not import Gtk.
+"""
+import os
+import hashlib
+import tempfile
+from urllib.parse import quote
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from azote.core import backends, formats
+
+# Folder name: maximum thumbnail dimension
+SIZES = [('normal', 128), ('large', 256), ('x-large', 512), ('xx-large', 1024)]
+
+# Other programs show thumbnails upright, while ours follow the pixel data, as wallpaper setters do
+TRANSPOSE = {2: Image.FLIP_LEFT_RIGHT, 3: Image.ROTATE_180, 4: Image.FLIP_TOP_BOTTOM, 5: Image.TRANSPOSE,
+             6: Image.ROTATE_270, 7: Image.TRANSVERSE, 8: Image.ROTATE_90}
+# Back from upright, to follow the pixel data
+UNDO_TRANSPOSE = dict(TRANSPOSE)
+UNDO_TRANSPOSE.update({6: Image.ROTATE_90, 8: Image.ROTATE_270})
+
+
+def cache_dir():
+    return os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.join(os.getenv('HOME'), '.cache'), 'thumbnails')
+
+
+def uri(path):
+    # As g_filename_to_uri() does, since that's what other programs hash
+    return 'file://' + quote(os.path.abspath(path), safe="/!~*'()&=:@+$,")
+
+
+def thumbnail_path(path, folder):
+    return os.path.join(cache_dir(), folder, '{}.png'.format(hashlib.md5(uri(path).encode()).hexdigest()))
+
+
+def sizes_for(thumb_size):
+    """
+    :return: folder names of shared thumbnails big enough to downscale to thumb_size, the smallest first
+    """
+    return [(folder, size) for folder, size in SIZES if size >= max(thumb_size)]
+
+
+def lookup(path, mtime, thumb_size):
+    """
+    :param path: source image
+    :param mtime: of the source image
+    :param thumb_size: (width, height) we need
+    :return: (PIL.Image, (width, height, format, orientation) of the source image), or None if no valid thumbnail
+    """
+    for folder, size in sizes_for(thumb_size):
+        try:
+            img = Image.open(thumbnail_path(path, folder))
+        except OSError:
+            continue
+        info = img.info
+        if info.get('Thumb::MTime') != str(int(mtime)) or info.get('Thumb::URI') != uri(path):
+            img.close()
+            continue
+        # Shared thumbnails are upright: we need the EXIF orientation from the image header, to turn them back
+        formats.register()
+        try:
+            with Image.open(path) as source:
+                source_info = backends.image_info(source)
+        except Exception:
+            img.close()
+            return None
+        orientation = source_info[3]
+        if orientation in UNDO_TRANSPOSE:
+            img = img.transpose(UNDO_TRANSPOSE[orientation])
+        img.thumbnail(thumb_size, Image.LANCZOS)
+        img.load()
+        return img, source_info
+    return None
+
+
+def save(img, path, mtime, image_size, orientation=None):
+    """
+    Stores the thumbnail for other programs to use
+    :param img: PIL.Image fitting the first of sizes_for() the thumbnail size
+    :param image_size: (width, height) of the source image
+    :param orientation: EXIF orientation of the source image
+    """
+    if orientation in TRANSPOSE:
+        img = img.transpose(TRANSPOSE[orientation])
+    folder = [f for f, size in SIZES if size >= max(img.size)][0]
+    target = thumbnail_path(path, folder)
+    os.makedirs(os.path.dirname(target), mode=0o700, exist_ok=True)
+
+    meta = PngInfo()
+    meta.add_text('Thumb::URI', uri(path))
+    meta.add_text('Thumb::MTime', str(int(mtime)))
+    meta.add_text('Thumb::Size', str(os.path.getsize(path)))
+    if image_size[0]:
+        meta.add_text('Thumb::Image::Width', str(image_size[0]))
+        meta.add_text('Thumb::Image::Height', str(image_size[1]))
+    meta.add_text('Software', 'Azote')
+
+    # The spec wants the file written aside, and renamed in place
+    fd, tmp_file = tempfile.mkstemp(suffix='.png', dir=os.path.dirname(target))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, 'PNG', pnginfo=meta)
+        os.replace(tmp_file, target)
+    except Exception:
+        os.remove(tmp_file)
+        raise
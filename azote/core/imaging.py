@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Image processing behind the GUI actions
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+"""
+import os
+
+from PIL import Image
+
+from azote.core import formats
+from azote.core.colorthief import ColorThief
+
+
+def scale_and_crop(image_path, width, height):
+    """
+    Fits the image to the display size, cropping what does not fit
+    :param image_path: source image
+    :param width: display width
+    :param height: display height
+    :return: path of the new image, saved next to the source one
+    """
+    formats.register()
+    img = Image.open(image_path)
+
+    # We can either scale vertically & crop horizontally or scale horizontally and crop vertically
+    new_height = int(img.size[0] * height / width)
+
+    if new_height < img.size[1]:  # we need to scale to display width and crop vertical margins
+        new_height = int(width * img.size[1] / img.size[0])
+        # Choose the filter depending on if we're scaling down or up
+        if new_height >= height:
+            img = img.resize((width, new_height), Image.LANCZOS)
+        else:
+            img = img.resize((width, new_height), Image.BILINEAR)
+
+        margin = (img.size[1] - height) // 2
+        img = img.crop((0, margin, width, height + margin))
+
+    elif new_height > img.size[1]:  # we need to scale to display height and crop horizontal margins
+        new_width = int(img.size[0] * height / img.size[1])
+        if new_width >= width:
+            img = img.resize((new_width, height), Image.LANCZOS)
+        else:
+            img = img.resize((new_width, height), Image.BILINEAR)
+
+        margin = (img.size[0] - width) // 2
+        img = img.crop((margin, 0, width + margin, height))
+
+    else:
+        img = img.resize((width, height), Image.LANCZOS)
+
+    path = '{}-{}x{}{}'.format(os.path.splitext(image_path)[0], width, height, os.path.splitext(image_path)[1])
+    img.save(path)
+    return path
+
+
+def palette(image_path, num_colors, quality=10):
+    """
+    :param quality: 1 is the best, and the slowest
+    :return: list of (r, g, b)
+    """
+    return ColorThief(image_path).get_palette(color_count=num_colors, quality=quality)
+
+
+def dominant_color(image_path, quality=10):
+    """
+    :return: (r, g, b)
+    """
+    return ColorThief(image_path).get_color(quality=quality)
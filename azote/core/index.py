@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Persistent index of thumbnails and image metadata, kept in a SQLite database
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+We use the index to tell if a thumbnail is up to date, instead of probing the thumbnails folder file by file.
+The module does not import Gtk: it's used from the thumbnails background thread.
+"""
+import sqlite3
+import threading
+from collections import namedtuple
+
+IndexEntry = namedtuple('IndexEntry', ['path', 'mtime', 'size', 'thumb_key', 'thumb_bytes', 'width', 'height',
+                                       'format', 'orientation'])
+# A file we failed to create the thumbnail for; not worth trying again until its mtime or size changes,
+# or until the decoder `configuration` (see backends.configuration()) does
+Failure = namedtuple('Failure', ['path', 'mtime', 'size', 'error', 'configuration'])
+
+SCHEMA_VERSION = 6
+
+# Seconds to wait for `azote --prewarm`, or another Azote instance, to finish writing to the database
+BUSY_TIMEOUT = 30
+
+
+class Index(object):
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_failures = []
+        # The connection is shared by the Gtk main loop and the thumbnails background thread; we use our own lock.
+        self.connection = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.migrate()
+
+    def migrate(self):
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS thumbnails ('
+                                    'path TEXT PRIMARY KEY, '
+                                    'mtime REAL, '
+                                    'size INTEGER, '
+                                    'thumb_key TEXT, '
+                                    'thumb_bytes INTEGER, '
+                                    'width INTEGER, '
+                                    'height INTEGER, '
+                                    'format TEXT)')
+        if version < 2:
+            # EXIF orientation
+            self.connection.execute('ALTER TABLE thumbnails ADD COLUMN orientation INTEGER')
+        if version < 3:
+            # store.Pack offsets
+            self.connection.execute('CREATE TABLE IF NOT EXISTS pack ('
+                                    'thumb_key TEXT PRIMARY KEY, '
+                                    'offset INTEGER, '
+                                    'width INTEGER, '
+                                    'height INTEGER)')
+        if version < 4:
+            # Content-based keys are shared by copies of a file
+            self.connection.execute('CREATE INDEX IF NOT EXISTS thumbnails_key ON thumbnails (thumb_key)')
+        if version < 5:
+            # Negative cache
+            self.connection.execute('CREATE TABLE IF NOT EXISTS failures ('
+                                    'path TEXT PRIMARY KEY, '
+                                    'mtime REAL, '
+                                    'size INTEGER, '
+                                    'error TEXT)')
+        if version < 6:
+            # Failures depend on backends, plugins and limits as well
+            self.connection.execute('ALTER TABLE failures ADD COLUMN configuration TEXT')
+        self.connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self.connection.commit()
+
+    def folder(self, folder):
+        """
+        All the entries for files inside the folder and its subfolders, in a single query
+        :param folder: full path
+        :return: dictionary {path: IndexEntry}
+        """
+        low, high = prefix_range(folder)
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute('SELECT * FROM thumbnails WHERE path > ? AND path < ?',
+                                           (low, high)).fetchall()
+        return dict((row[0], IndexEntry(*row)) for row in rows)
+
+    def get(self, path):
+        self.flush()
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM thumbnails WHERE path = ?', (path,)).fetchone()
+        return IndexEntry(*row) if row else None
+
+    def find_key(self, thumb_key):
+        """
+        :return: any IndexEntry using the thumbnail, or None
+        """
+        self.flush()
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM thumbnails WHERE thumb_key = ? LIMIT 1',
+                                          (thumb_key,)).fetchone()
+        return IndexEntry(*row) if row else None
+
+    def add(self, entry):
+        """
+        Entries are written in batches: call flush() to make sure all of them got saved
+        :param entry: IndexEntry
+        """
+        with self.lock:
+            self.pending.append(entry)
+            ready = len(self.pending) >= 100
+        if ready:
+            self.flush()
+
+    def fail(self, failure):
+        """
+        Written in batches, along with entries from add()
+        :param failure: Failure
+        """
+        with self.lock:
+            self.pending_failures.append(failure)
+
+    def failures(self, folder):
+        """
+        :param folder: full path
+        :return: dictionary {path: Failure} for files inside the folder and its subfolders
+        """
+        low, high = prefix_range(folder)
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute('SELECT * FROM failures WHERE path > ? AND path < ?',
+                                           (low, high)).fetchall()
+        return dict((row[0], Failure(*row)) for row in rows)
+
+    def flush(self):
+        with self.lock:
+            if self.pending_failures:
+                self.connection.executemany('INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?)',
+                                            self.pending_failures)
+                self.pending_failures = []
+            if self.pending:
+                self.connection.executemany('INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                            self.pending)
+                # Fixed, or replaced with a good file
+                self.connection.executemany('DELETE FROM failures WHERE path = ?', [(e.path,) for e in self.pending])
+                self.pending = []
+            self.connection.commit()
+
+    def set_image_info(self, path, width, height, fmt, orientation):
+        """
+        Stores details of the source image, for entries created without them
+        """
+        self.flush()
+        with self.lock:
+            self.connection.execute('UPDATE thumbnails SET width = ?, height = ?, format = ?, orientation = ? '
+                                    'WHERE path = ?', (width, height, fmt, orientation, path))
+            self.connection.commit()
+
+    def remove(self, paths):
+        self.flush()
+        with self.lock:
+            self.connection.executemany('DELETE FROM thumbnails WHERE path = ?', [(p,) for p in paths])
+            self.connection.executemany('DELETE FROM failures WHERE path = ?', [(p,) for p in paths])
+            self.connection.commit()
+
+    def retain(self, folder):
+        """
+        Removes entries for files outside the folder
+        :return: set of thumbnail keys still in use
+        """
+        low, high = prefix_range(folder)
+        self.flush()
+        with self.lock:
+            self.connection.execute('DELETE FROM thumbnails WHERE NOT (path > ? AND path < ?)', (low, high))
+            self.connection.execute('DELETE FROM failures WHERE NOT (path > ? AND path < ?)', (low, high))
+            self.connection.commit()
+            rows = self.connection.execute('SELECT thumb_key FROM thumbnails').fetchall()
+        return set(row[0] for row in rows)
+
+    def clear(self):
+        with self.lock:
+            self.pending = []
+            self.pending_failures = []
+            self.connection.execute('DELETE FROM thumbnails')
+            self.connection.execute('DELETE FROM failures')
+            self.connection.commit()
+
+    def stats(self):
+        """
+        :return: (number of thumbnails, their total size in bytes)
+        """
+        self.flush()
+        with self.lock:
+            # Files sharing a thumbnail are only counted once
+            row = self.connection.execute('SELECT COUNT(*), SUM(bytes) FROM (SELECT MAX(thumb_bytes) AS bytes '
+                                          'FROM thumbnails WHERE thumb_key IS NOT NULL GROUP BY thumb_key)').fetchone()
+        return row[0], row[1] or 0
+
+    def pack_entries(self):
+        """
+        :return: dictionary {thumb_key: (offset, width, height)} of all the thumbnails in the pack
+        """
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute('SELECT * FROM pack').fetchall()
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def pack_put(self, key, offset, width, height):
+        """
+        Committed at once, not in batches: another process compacting the pack reads offsets from the database
+        """
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO pack VALUES (?, ?, ?, ?)', (key, offset, width, height))
+            self.connection.commit()
+
+    def pack_remove(self, keys):
+        self.flush()
+        with self.lock:
+            self.connection.executemany('DELETE FROM pack WHERE thumb_key = ?', [(k,) for k in keys])
+            self.connection.commit()
+
+    def pack_replace(self, entries):
+        """
+        Replaces all the offsets at once, after the pack has been rewritten
+        """
+        self.flush()
+        with self.lock:
+            self.connection.execute('DELETE FROM pack')
+            self.connection.executemany('INSERT INTO pack VALUES (?, ?, ?, ?)',
+                                        [(k,) + tuple(v) for k, v in entries.items()])
+            self.connection.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+def prefix_range(folder):
+    """
+    Paths inside the folder sort between 'folder/' and 'folder0' ('0' follows '/' in ASCII),
+    which lets SQLite use the primary key index instead of LIKE.
+    """
+    folder = folder.rstrip('/')
+    return folder + '/', folder + '0'
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Wallpapers folder scanning, and finding images which need a new thumbnail
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+Used by the GUI, from the thumbnails background thread, and by `azote --prewarm`.
+"""
+import os
+import stat
+import struct
+import hashlib
+from collections import namedtuple
+
+from azote.core import backends
+from azote.core.thumbnailer import ThumbJob
+from azote.core.index import IndexEntry, Failure
+
+# Snapshot of a single image file, as seen by scan_folder()
+FileInfo = namedtuple('FileInfo', ['path', 'mtime', 'size', 'ext'])
+
+# Lowercase extensions of files we take for images, unless told otherwise
+IMAGE_EXTENSIONS = frozenset(['jpg', 'jpeg', 'jxl', 'png', 'webp', 'heic', 'avif'])
+
+
+def hash_name(full_path):
+    """
+    Thumbnail path -> name (w/o extension)
+    :param full_path: original file path
+    :return: MD5-hashed path
+    """
+    return hashlib.md5(full_path.encode()).hexdigest()
+
+
+def scan_folder(folder, extensions=IMAGE_EXTENSIONS, cancelled=None):
+    """
+    Lists images in the folder and its subfolders in a single pass. We used to call `find` for this.
+    Subfolders we can't read are skipped; the folder itself missing raises FileNotFoundError.
+    :param folder: full path
+    :param extensions: lowercase extensions of files to list
+    :param cancelled: threading.Event; once set, we stop walking and return what we've found so far
+    :return: list of FileInfo
+    """
+    files = []
+    folders = [folder]
+    while folders and not (cancelled and cancelled.is_set()):
+        path = folders.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                        continue
+                    ext = image_ext(entry.name, extensions)
+                    if ext:
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        files.append(FileInfo(entry.path, st.st_mtime, st.st_size, ext))
+        except OSError:
+            if path == folder:
+                raise
+    return files
+
+
+def file_info(path, extensions=IMAGE_EXTENSIONS):
+    """
+    Snapshot of a single file, as scan_folder() would see it
+    :return: FileInfo, or None if not an image of allowed type, or gone
+    """
+    ext = image_ext(os.path.basename(path), extensions)
+    if ext:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(st.st_mode):
+            return FileInfo(path, st.st_mtime, st.st_size, ext)
+    return None
+
+
+def image_ext(name, extensions=IMAGE_EXTENSIONS):
+    """
+    :return: lowercase extension if in `extensions`, None otherwise
+    """
+    _, dot, ext = name.rpartition('.')
+    ext = ext.lower()
+    return ext if dot and ext in extensions else None
+
+
+def content_key(path, size):
+    """
+    Thumbnail name based on the file content instead of its path, so that the thumbnail survives renaming
+    and moving the file, and copies share it. For speed we only hash the size, and the first and the last 64 KB:
+    edited and re-encoded images differ there, as headers and entropy-coded data both change.
+    :return: MD5 hex digest
+    """
+    digest = hashlib.md5(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(65536))
+        if size > 131072:
+            f.seek(-65536, os.SEEK_END)
+            digest.update(f.read(65536))
+    return digest.hexdigest()
+
+
+def png_width(png_file):
+    """
+    Reads the width from the PNG header, without decoding anything
+    :return: width in pixels, or None if not a PNG file
+    """
+    try:
+        with open(png_file, 'rb') as f:
+            header = f.read(24)
+    except OSError:
+        return None
+    if len(header) < 24 or header[:8] != b'\x89PNG\r\n\x1a\n':
+        return None
+    return struct.unpack('>I', header[16:20])[0]
+
+
+def find_thumbnail_jobs(writer, scr_path, files, thumb_dir, thumb_size, backend='auto', max_pixels=0, store='png',
+                        keys='path', shared='off', cancelled=None, on_reused=None):
+    """
+    Lists images which need a new thumbnail. Runs in the background thread, so must not touch Gtk.
+    Whether a thumbnail is up to date, we learn from the index, not from the thumbnails folder.
+    Files we failed to create the thumbnail for are skipped, until modified, or until the decoder configuration changes.
+    Thumbnails created for a smaller master width get created again; they may be shown upscaled in the meantime.
+    :param writer: store.Writer, along with its index and pack
+    :param scr_path: folder to create thumbnails for
+    :param files: list of FileInfo from scan_folder(scr_path)
+    :param store: 'png' or 'pack'; PNG files found with the 'pack' store get moved into the pack
+    :param keys: 'path' to name thumbnails after hash_name(), 'content' after content_key()
+    :param shared: 'off', 'read' or 'write' thumbnails in ~/.cache/thumbnails, see freedesktop.py
+    :param cancelled: threading.Event; once set, we stop scanning and return what we've found so far
+    :param on_reused: function(IndexEntry), called for files indexed here with an existing thumbnail, which get no job
+    :return: list of ThumbJob
+    """
+    index = writer.index
+    # Thumbnails of the previous task may still be on their way to the index
+    writer.flush()
+    indexed = index.folder(scr_path)
+    failed = index.failures(scr_path)
+    configuration = backends.configuration(backend, max_pixels)
+    pack = writer.pack if store == 'pack' else None
+
+    def stored(key):
+        return key in pack if pack else os.path.isfile(os.path.join(thumb_dir, "{}.png".format(key)))
+
+    def smaller(key, dest_path):
+        if pack:
+            size = pack.size(key)
+            width = size[0] if size else None
+        else:
+            # With the 'png' store it costs reading the header of each thumbnail
+            width = png_width(dest_path)
+        return width is not None and width < thumb_size[0]
+
+    jobs = []
+
+    def reuse(entry):
+        index.add(entry)
+        if on_reused:
+            on_reused(entry)
+
+    def add_job(file, dest_path, refresh):
+        jobs.append(ThumbJob(file.path, dest_path, thumb_size, refresh, file.mtime, file.size, backend, max_pixels,
+                             store, shared, file.ext in backends.EMBEDDED_PREVIEWS))
+
+    for file in files:
+        if cancelled and cancelled.is_set():
+            break
+        in_path = file.path
+        failure = failed.get(in_path)
+        if failure and failure.mtime == file.mtime and failure.size == file.size and \
+                failure.configuration == configuration:
+            continue
+        entry = indexed.get(in_path)
+        if entry and entry.mtime == file.mtime and entry.size == file.size:
+            dest_path = os.path.join(thumb_dir, "{}.png".format(entry.thumb_key))
+            if pack and entry.thumb_key not in pack and not pack.import_png(entry.thumb_key, dest_path, thumb_size):
+                add_job(file, dest_path, True)
+            elif smaller(entry.thumb_key, dest_path):
+                add_job(file, dest_path, True)
+            continue
+
+        if keys == 'content':
+            try:
+                thumb_key = content_key(in_path, file.size)
+            except OSError:
+                continue
+            known = index.find_key(thumb_key)
+            if known and stored(thumb_key):
+                # Renamed, moved or copied: the thumbnail and details of the image are there already
+                reuse(known._replace(path=in_path, mtime=file.mtime, size=file.size))
+            else:
+                dest_path = os.path.join(thumb_dir, "{}.png".format(thumb_key))
+                add_job(file, dest_path, entry is not None)
+            continue
+
+        if entry:
+            # The old key may be content-based, and shared by copies of the file we must not overwrite
+            dest_path = os.path.join(thumb_dir, "{}.png".format(hash_name(in_path)))
+            add_job(file, dest_path, True)
+            continue
+
+        # Not indexed yet: the thumbnail may have been created by a previous version
+        thumb_key = hash_name(in_path)
+        dest_path = os.path.join(thumb_dir, "{}.png".format(thumb_key))
+        try:
+            thumb_st = os.stat(dest_path)
+        except FileNotFoundError:
+            add_job(file, dest_path, False)
+            continue
+        if file.mtime > thumb_st.st_mtime or (pack and not pack.import_png(thumb_key, dest_path, thumb_size)) or \
+                smaller(thumb_key, dest_path):
+            add_job(file, dest_path, True)
+        else:
+            thumb_bytes = thumb_size[0] * thumb_size[1] * 3 if pack else thumb_st.st_size
+            reuse(IndexEntry(in_path, file.mtime, file.size, thumb_key, thumb_bytes, None, None, None, None))
+    index.flush()
+    return jobs
+
+
+def store_result(writer, result):
+    """
+    Hands the new thumbnail over to the writer, or records the failure in its index.
+    Called from the thumbnails background thread.
+    :param writer: store.Writer
+    :param result: thumbnailer.ThumbResult, not a draft
+    :return: IndexEntry, or Failure
+    """
+    job = result.job
+    if result.error:
+        failure = Failure(job.in_path, job.mtime, job.size, result.error,
+                          backends.configuration(job.backend, job.max_pixels))
+        writer.index.fail(failure)
+        return failure
+    thumb_key = os.path.splitext(os.path.basename(job.dest_path))[0]
+    entry = IndexEntry(job.in_path, job.mtime, job.size, thumb_key, result.thumb_bytes, result.width, result.height,
+                       result.format, result.orientation)
+    writer.write(entry, result.pixels, job.thumb_size, job.dest_path, job.store)
+    return entry
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Thumbnails packed into a single file of raw RGB pixels, instead of one PNG file per image
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+New thumbnails are appended to the pack; offsets are kept in the `pack` table of the index. Replaced and removed
+thumbnails leave garbage behind, which compact() gets rid of. The module does not import Gtk.
+
+`azote --prewarm` may be using the pack along with the GUI: appending and compacting take a lock on the file,
+and offsets get committed to the index right away, for the other process to find them.
+
+Thumbnails are written by the Writer background thread: the GUI shows them from memory in the meantime.
+"""
+import os
+import mmap
+import fcntl
+import queue
+import threading
+
+from PIL import Image
+
+from azote.core import thumbnailer
+
+
+class Pack(object):
+    def __init__(self, pack_file, index):
+        """
+        :param pack_file: full path
+        :param index: index.Index, which keeps offsets
+        """
+        self.pack_file = pack_file
+        self.index = index
+        self.lock = threading.Lock()
+        self.entries = {}     # thumb_key: (offset, width, height)
+        self.file = open(pack_file, 'a+b')
+        self.map = None
+        with self.lock:
+            self.acquire()
+            try:
+                self.entries = self.load_entries()
+            finally:
+                self.release()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def size(self, key):
+        """
+        :return: (width, height) of the thumbnail, or None if not in the pack
+        """
+        entry = self.entries.get(key)
+        return entry[1:] if entry else None
+
+    def acquire(self):
+        """
+        Takes the lock on the pack file, which `azote --prewarm` or another Azote instance may be using as well.
+        If the other process has replaced the file meanwhile (see compact()), we reopen it, and reload offsets.
+        Must be called with self.lock held.
+        """
+        reopened = False
+        while True:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.pack_file)
+            except FileNotFoundError:
+                current = None
+            opened = os.fstat(self.file.fileno())
+            if current and (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino):
+                break
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.reopen()
+            reopened = True
+        if reopened:
+            self.entries = self.load_entries()
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def reopen(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+        self.file = open(self.pack_file, 'a+b')
+
+    def load_entries(self):
+        """
+        Offsets from the index, but only those within the file: the pack may have been deleted, or truncated,
+        while the index kept them. Thumbnails gone get removed from the index, and will be created again.
+        Must be called with the file lock held.
+        :return: dictionary {thumb_key: (offset, width, height)}
+        """
+        entries = self.index.pack_entries()
+        size = os.fstat(self.file.fileno()).st_size
+        lost = [key for key, (offset, width, height) in entries.items() if offset + width * height * 3 > size]
+        if lost:
+            self.index.pack_remove(lost)
+            for key in lost:
+                del entries[key]
+        return entries
+
+    def put(self, key, width, height, pixels):
+        """
+        Called from the thumbnails background thread
+        :param pixels: raw RGB bytes
+        """
+        with self.lock:
+            self.acquire()
+            try:
+                offset = self.file.seek(0, os.SEEK_END)
+                self.file.write(pixels)
+                self.file.flush()
+                # Before releasing the lock: whoever compacts the pack next, must know the offset
+                self.index.pack_put(key, offset, width, height)
+            finally:
+                self.release()
+            self.entries[key] = (offset, width, height)
+
+    def get(self, key):
+        """
+        :return: (raw RGB bytes, width, height), or None if not in the pack
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            offset, width, height = entry
+            end = offset + width * height * 3
+            if self.map is None or end > len(self.map):
+                # The pack has grown since mapped
+                if self.map is not None:
+                    self.map.close()
+                    self.map = None
+                if end > os.fstat(self.file.fileno()).st_size:
+                    # Truncated behind our back
+                    del self.entries[key]
+                    self.index.pack_remove([key])
+                    return None
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.map[offset:end], width, height
+
+    def import_png(self, key, png_file, thumb_size):
+        """
+        Moves a thumbnail created by a previous version into the pack
+        :return: True on success
+        """
+        try:
+            with Image.open(png_file) as img:
+                if img.size != tuple(thumb_size):
+                    return False
+                # Transparent areas of thumbnails made by previous versions show the checkered background
+                pixels = thumbnailer.expand_img(img, thumb_size).convert('RGB').tobytes()
+        except Exception:
+            return False
+        self.put(key, thumb_size[0], thumb_size[1], pixels)
+        os.remove(png_file)
+        return True
+
+    def export_png(self, key, png_file):
+        """
+        Saves the thumbnail as a PNG file, for things which need one (e.g. DisplayBox, saved wallpaper settings)
+        """
+        found = self.get(key)
+        if found:
+            pixels, width, height = found
+            Image.frombytes('RGB', (width, height), pixels).save(png_file, 'PNG')
+
+    def remove(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+            self.index.pack_remove(keys)
+
+    def garbage(self):
+        """
+        Other processes may have added thumbnails: we count those the index knows, not only our own
+        :return: bytes taken by replaced and removed thumbnails
+        """
+        with self.lock:
+            used = sum(width * height * 3 for offset, width, height in self.index.pack_entries().values())
+            try:
+                return os.path.getsize(self.pack_file) - used
+            except OSError:
+                return 0
+
+    def compact(self, keep=None):
+        """
+        Rewrites the pack without garbage. Holds the file lock all the way, so that no other process appends
+        to the file being replaced.
+        :param keep: set of thumbnail keys still in use, or None to keep all the thumbnails in the pack
+        """
+        with self.lock:
+            self.acquire()
+            try:
+                # Including thumbnails added by other processes
+                current = self.load_entries()
+                if keep is not None:
+                    current = dict((k, v) for k, v in current.items() if k in keep)
+                tmp_file = '{}.tmp'.format(self.pack_file)
+                entries = {}
+                with open(self.pack_file, 'rb') as source, open(tmp_file, 'wb') as target:
+                    for key, (offset, width, height) in sorted(current.items(), key=lambda item: item[1][0]):
+                        source.seek(offset)
+                        entries[key] = (target.tell(), width, height)
+                        target.write(source.read(width * height * 3))
+                    target.flush()
+                    os.fsync(target.fileno())
+                os.replace(tmp_file, self.pack_file)
+                self.index.pack_replace(entries)
+                self.entries = entries
+            finally:
+                # Others waiting for the lock will find the file replaced, and reopen it
+                self.release()
+            self.reopen()
+
+    def clear(self):
+        self.compact(keep=set())
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+            self.file.close()
+
+
+class Writer(object):
+    """
+    Stores new thumbnails, in the pack or as PNG files, in its own thread. The index entry is only added once
+    the thumbnail is on disk, so that an interrupted write just means creating the thumbnail again.
+    """
+    def __init__(self, pack, index):
+        """
+        :param pack: Pack
+        :param index: index.Index
+        """
+        self.pack = pack
+        self.index = index
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, entry, pixels, size, dest_path, store):
+        """
+        May be called from any thread
+        :param entry: index.IndexEntry
+        :param pixels: raw RGB bytes of the thumbnail
+        :param size: (width, height) of the thumbnail
+        :param dest_path: PNG file; with the 'pack' store only refreshed if exported before, and still there
+        :param store: 'pack' or 'png'
+        """
+        self.queue.put((entry, pixels, size, dest_path, store))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.store(*item)
+            except Exception as e:
+                # e.g. the database locked by `azote --prewarm` for too long: the thread must go on, or flush() hangs
+                print('Azote: failed to store the thumbnail of {}: {}'.format(item[0].path, e))
+            finally:
+                self.queue.task_done()
+
+    def store(self, entry, pixels, size, dest_path, store):
+        key = entry.thumb_key
+        if store == 'pack':
+            self.pack.put(key, size[0], size[1], pixels)
+            if os.path.isfile(dest_path):
+                # Exported earlier, and might be in use
+                self.pack.export_png(key, dest_path)
+        else:
+            Image.frombytes('RGB', size, pixels).save(dest_path, 'PNG')
+            if key in self.pack:
+                # Replaced with a PNG file
+                self.pack.remove([key])
+            entry = entry._replace(thumb_bytes=os.path.getsize(dest_path))
+        self.index.add(entry)
+
+    def flush(self):
+        """
+        Waits until everything queued so far has been written
+        """
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
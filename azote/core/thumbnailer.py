@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Thumbnail engine for Azote: creates thumbnails in a pool of worker processes
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+This module must not import Gtk: its functions are executed in worker processes.
+"""
+import os
+import time
+import functools
+import queue
+import threading
+import multiprocessing
+from collections import namedtuple, OrderedDict
+
+from PIL import Image
+
+from azote.core import backends, freedesktop
+
+images_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'images')
+
+# Everything the worker needs to know, as we can not rely on `common` in a child process
+ThumbJob = namedtuple('ThumbJob', ['in_path', 'dest_path', 'thumb_size', 'refresh', 'mtime', 'size', 'backend',
+                                   'max_pixels', 'store', 'shared', 'embedded'])
+# What the worker learned about the source image, besides creating the thumbnail.
+# The thumbnail comes back as raw RGB `pixels`: the parent process shows them right away, and stores them on its own.
+# A `draft` comes from the preview embedded in the file: to show until the real thumbnail is ready.
+ThumbResult = namedtuple('ThumbResult', ['job', 'width', 'height', 'format', 'orientation', 'thumb_bytes', 'pixels',
+                                         'error', 'draft'])
+
+# Seconds to wait for jobs which may have been running in a worker process which died
+LOST_JOB_TIMEOUT = 30
+WORKER_DIED = 'worker process died'
+
+_pool = None
+_pool_size = 0
+
+
+def worker_count(workers=0):
+    """
+    :param workers: value from azoterc, 0 means "as many as CPU cores"
+    :return: number of worker processes to use
+    """
+    if workers > 0:
+        return workers
+    return os.cpu_count() or 1
+
+
+def get_pool(workers):
+    """
+    The pool is created once and reused for subsequent folders
+    :param workers: number of worker processes
+    :return: multiprocessing.Pool instance
+    """
+    global _pool, _pool_size
+    if _pool is not None and _pool_size != workers:
+        shutdown()
+    if _pool is None:
+        # 'fork' is the cheapest here: workers do not need to re-import anything
+        _pool = multiprocessing.get_context('fork').Pool(processes=workers)
+        _pool_size = workers
+    return _pool
+
+
+def shutdown():
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+        _pool_size = 0
+
+
+@functools.lru_cache(maxsize=4)
+def checkerboard(thumb_size):
+    """
+    Background for thumbnails of images in proportions other than 16:9. Every process creates it once per size.
+    Do not modify the returned image: paste onto a copy.
+    """
+    background = Image.open(os.path.join(images_dir, 'squares.jpg'))
+    return background.resize(thumb_size, Image.LANCZOS)
+
+
+def expand_img(image, thumb_size):
+    # We want the thumbnail to be always in the same proportion. Let's expand if necessary.
+    # Transparent images are composited onto the checkered background too, as we store RGB pixels only.
+    transparent = has_alpha(image)
+    width, height = image.size
+    if width >= thumb_size[0] and height >= thumb_size[1] and not transparent:
+        # proportions match already, nothing to composite
+        return image
+    border_h = max(0, (thumb_size[0] - width) // 2)
+    border_v = max(0, (thumb_size[1] - height) // 2)
+    if border_v > 0 or border_h > 0 or transparent:
+        # Let's add checkered background instead of the black one
+        background = checkerboard(tuple(thumb_size)).copy()
+        if transparent:
+            image = image.convert('RGBA')
+            background.paste(image, (border_h, border_v), image)
+        else:
+            background.paste(image, (border_h, border_v))
+        return background
+    else:
+        return image
+
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in image.info
+
+
+def make_thumbnail(job):
+    """
+    Runs in a worker process
+    :param job: ThumbJob
+    :return: ThumbResult
+    """
+    if job.embedded:
+        try:
+            found = backends.embedded_preview(job.in_path)
+        except Exception:
+            found = None
+        if found:
+            return make_draft(job, *found)
+    try:
+        img, (width, height, fmt, orientation) = decode(job)
+
+        img = expand_img(img, job.thumb_size)
+        if img.size != tuple(job.thumb_size):
+            img = img.resize(job.thumb_size)
+        pixels = img.convert('RGB').tobytes()
+        return ThumbResult(job, width, height, fmt, orientation, len(pixels), pixels, None, False)
+    except Exception as e:
+        return ThumbResult(job, None, None, None, None, None, None, str(e), False)
+
+
+def make_draft(job, preview, info):
+    """
+    Scales the embedded preview to the thumbnail size. Previews are usually smaller than thumbnails: quality does not
+    matter here, speed does.
+    """
+    scale = min(job.thumb_size[0] / preview.size[0], job.thumb_size[1] / preview.size[1])
+    size = (max(1, round(preview.size[0] * scale)), max(1, round(preview.size[1] * scale)))
+    img = preview.convert('RGB').resize(size, Image.BILINEAR)
+    img = expand_img(img, job.thumb_size)
+    if img.size != tuple(job.thumb_size):
+        img = img.resize(job.thumb_size)
+    pixels = img.convert('RGB').tobytes()
+    width, height, fmt, orientation = info
+    return ThumbResult(job, width, height, fmt, orientation, len(pixels), pixels, None, True)
+
+
+def decode(job):
+    """
+    Uses a thumbnail in ~/.cache/thumbnails if valid, and may save one there, as set with job.shared
+    :return: (thumbnail as PIL.Image, (width, height, format, orientation) of the source image)
+    """
+    sizes = freedesktop.sizes_for(job.thumb_size) if job.shared in ('read', 'write') else None
+    if sizes:
+        found = freedesktop.lookup(job.in_path, job.mtime, job.thumb_size)
+        if found:
+            return found
+        if job.shared == 'write':
+            size = sizes[0][1]
+            img, info = backends.thumbnail(job.in_path, (size, size), job.backend, job.max_pixels)
+            try:
+                freedesktop.save(img, job.in_path, job.mtime, info[:2], info[3])
+            except OSError:
+                pass
+            img.thumbnail(job.thumb_size, Image.LANCZOS)
+            return img, info
+    return backends.thumbnail(job.in_path, job.thumb_size, job.backend, job.max_pixels)
+
+
+class Task(object):
+    """
+    Creates thumbnails in a background thread, which feeds the worker pool and collects results.
+    Callbacks are called from the background thread: the GUI needs to pass them to its main loop on its own.
+    Jobs with `embedded` set give a draft result first; the real thumbnail follows once all drafts are done.
+    """
+
+    def __init__(self, collect, workers, on_result=None, on_finished=None):
+        """
+        :param collect: function returning the list of ThumbJob; called in the background thread, should return
+                        early if the task gets cancelled
+        :param workers: number of worker processes
+        :param on_result: function(ThumbResult, done, total), called after each job, and after each draft
+        :param on_finished: function(cancelled), called at the end, also if collect or a callback raised
+        """
+        self.collect = collect
+        self.workers = workers
+        self.on_result = on_result
+        self.on_finished = on_finished
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.urgent = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        # The pool must be created in the main thread, before any background thread forks it
+        if self.workers > 1:
+            get_pool(self.workers)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def join(self):
+        """
+        Waits for the task to finish, for callers without a main loop
+        """
+        self.thread.join()
+
+    def prioritize(self, paths):
+        """
+        Jobs for these source paths will be submitted next, in the given order. May be called from any thread,
+        also before the jobs have been collected. The latest call replaces the previous one.
+        :param paths: list of source image paths, e.g. visible in the preview first, then the next screenful
+        """
+        with self.lock:
+            self.urgent = list(paths)
+
+    def next_job(self, pending, refine):
+        """
+        :param pending: OrderedDict of jobs not yet submitted
+        :param refine: OrderedDict of jobs to replace drafts with, only submitted when nothing else is pending
+        """
+        with self.lock:
+            urgent, self.urgent = self.urgent, None
+        if urgent:
+            for jobs in (pending, refine):
+                for path in reversed(urgent):
+                    if path in jobs:
+                        jobs.move_to_end(path, last=False)
+        return (pending or refine).popitem(last=False)[1]
+
+    def run(self):
+        try:
+            self.process()
+        finally:
+            if self.on_finished:
+                self.on_finished(self.cancelled.is_set())
+
+    def process(self):
+        jobs = self.collect() if not self.cancelled.is_set() else []
+        total = len(jobs)
+        done = 0
+        pending = OrderedDict((job.in_path, job) for job in jobs)
+        refine = OrderedDict()
+        if self.workers < 2 or total < 2:
+            while (pending or refine) and not self.cancelled.is_set():
+                result = make_thumbnail(self.next_job(pending, refine))
+                if result.draft:
+                    refine[result.job.in_path] = result.job._replace(embedded=False)
+                else:
+                    done += 1
+                if self.on_result:
+                    self.on_result(result, done, total)
+        else:
+            pool = get_pool(self.workers)
+            results = queue.Queue()
+            # Do not submit everything at once, or we would not be able to stop, nor to follow priorities
+            window = self.workers * 2
+            # in_path: (job, deadline); the deadline is only set once a worker dies, see lost_jobs()
+            in_flight = {}
+            workers = worker_pids(pool)
+            while pending or refine or in_flight:
+                while (pending or refine) and len(in_flight) < window and not self.cancelled.is_set():
+                    job = self.next_job(pending, refine)
+                    pool.apply_async(make_thumbnail, (job,), callback=results.put,
+                                     error_callback=lambda e, j=job: results.put(
+                                         ThumbResult(j, None, None, None, None, None, None, str(e), False)))
+                    in_flight[job.in_path] = (job, None)
+                if not in_flight:
+                    break
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    workers = lost_jobs(pool, workers, in_flight, results)
+                    continue
+                if in_flight.pop(result.job.in_path, None) is None:
+                    # Given up on already
+                    continue
+                if result.draft:
+                    refine[result.job.in_path] = result.job._replace(embedded=False)
+                else:
+                    done += 1
+                if self.on_result and not self.cancelled.is_set():
+                    self.on_result(result, done, total)
+
+
+def worker_pids(pool):
+    return set(process.pid for process in pool._pool)
+
+
+def lost_jobs(pool, workers, in_flight, results):
+    """
+    multiprocessing.Pool replaces a worker which got killed (e.g. by the OOM killer, on a huge image), but never
+    returns anything for the job it was running. We can't tell which job it was: jobs submitted before a worker died
+    get LOST_JOB_TIMEOUT seconds to finish, and those still running by then are given up with an error.
+    :param workers: set of worker process ids, as returned by the previous call, or by worker_pids()
+    :param in_flight: dictionary {in_path: (job, deadline)}, deadlines get set and checked here
+    :param results: queue to put the error results to
+    :return: current set of worker process ids
+    """
+    current = worker_pids(pool)
+    now = time.time()
+    if workers - current:
+        for path, (job, deadline) in in_flight.items():
+            if deadline is None:
+                in_flight[path] = (job, now + LOST_JOB_TIMEOUT)
+    for path, (job, deadline) in list(in_flight.items()):
+        if deadline is not None and now > deadline:
+            results.put(ThumbResult(job, None, None, None, None, None, None, WORKER_DIED, False))
+            in_flight[path] = (job, float('inf'))
+    return current
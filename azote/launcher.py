@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Entry point of the `azote` command: opens the GUI, unless asked to run headless
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+Gtk gets imported along with azote.main, so we decide before importing it.
+"""
+import sys
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '--prewarm':
+        if len(args) < 2:
+            print('Usage: azote --prewarm DIR...', file=sys.stderr)
+            return 2
+        from azote import prewarm
+        return prewarm.main(args[1:])
+
+    from azote import main as gui
+    return gui.main()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
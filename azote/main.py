@@ -14,6 +14,8 @@ import os
 import sys
 import subprocess
 import stat
+import threading
+from collections import OrderedDict
 
 import gi
 import cairo
@@ -47,16 +49,23 @@ except Exception:
     common.env['send2trash'] = False
     print('python-send2trash package not found - deleting pictures unavailable')
 
-from azote.colorthief import ColorThief
+from azote.core import imaging
 
 dir_name = os.path.dirname(__file__)
+placeholder = None  # pixbuf to display until the thumbnail is ready
+broken = None  # pixbuf to display for images we failed to create the thumbnail for
+pixbuf_cache = None  # PixbufCache of thumbnails recently in sight
 
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GdkPixbuf, Gdk, GLib
 from gi.repository.GdkPixbuf import InterpType
-from azote.tools import set_env, hash_name, create_thumbnails, file_allowed, update_status_bar, flip_selected_wallpaper, \
+from azote.tools import set_env, create_thumbnails, update_status_bar, flip_selected_wallpaper, \
     copy_backgrounds, create_pixbuf, split_selected_wallpaper, scale_and_crop, clear_thumbnails, current_display, \
-    save_json, load_json
+    save_json, load_json, log
+from azote.core import thumbnailer
+from azote.core.scan import FileInfo, hash_name, scan_folder, file_info
+from azote.core.backends import image_info
+from azote.watcher import Watcher
 from azote.color_tools import rgba_to_hex, hex_to_rgb, rgb_to_hex, rgb_to_rgba
 from azote.plugins import Alacritty, Xresources
 from azote.color_tools import WikiColours
@@ -82,27 +91,38 @@ except Exception as e:
 from azote.__about__ import __version__
 
 
-def get_files():
-    try:
-        inames = "-iname \"*." + "\" -o -iname \"*.".join(common.allowed_file_types) + "\""
-        files = subprocess.check_output("find '%s' -mindepth 1 %s" % (common.settings.src_path, inames),
-                                        shell=True).decode().split("\n")[:-1]
-        file_names = [f.replace(common.settings.src_path + "/", "") for f in files]
-    except FileNotFoundError:
-        common.settings.src_path = os.getenv('HOME')
-        file_names = [f for f in os.listdir(common.settings.src_path)
-                      if os.path.isfile(os.path.join(common.settings.src_path, f))]
+def sort_key(file):
+    """
+    :param file: FileInfo
+    :return: key to sort files as selected with the SortingButton, see sort_descending()
+    """
+    if common.settings.sorting in ('new', 'old'):
+        return file.mtime
+    return file.path
 
-    if common.settings.sorting == 'new':
-        file_names.sort(reverse=True, key=lambda f: os.path.getmtime(os.path.join(common.settings.src_path, f)))
-    elif common.settings.sorting == 'old':
-        file_names.sort(key=lambda f: os.path.getmtime(os.path.join(common.settings.src_path, f)))
-    elif common.settings.sorting == 'az':
-        file_names.sort()
-    elif common.settings.sorting == 'za':
-        file_names.sort(reverse=True)
 
-    return file_names
+def sort_descending():
+    return common.settings.sorting in ('new', 'za')
+
+
+def get_files(snapshot):
+    """
+    :param snapshot: list of FileInfo from scan_folder()
+    :return: paths relative to the source folder, sorted as selected with the SortingButton
+    """
+    start = len(common.settings.src_path.rstrip('/')) + 1
+    return [f.path[start:] for f in sorted(snapshot, key=sort_key, reverse=sort_descending())]
+
+
+def scan_src_path():
+    """
+    :return: list of FileInfo for the source folder; we fall back to the home folder if it's gone
+    """
+    try:
+        return scan_folder(common.settings.src_path, common.allowed_file_types)
+    except OSError:
+        common.settings.src_path = os.getenv('HOME')
+        return scan_folder(common.settings.src_path, common.allowed_file_types)
 
 
 class Preview(Gtk.ScrolledWindow):
@@ -114,51 +134,458 @@ class Preview(Gtk.ScrolledWindow):
         self.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.ALWAYS)
 
         common.thumbnails_list = []
-        self.grid = Gtk.FlowBox()
-        self.grid.set_valign(Gtk.Align.START)
-        # self.grid.set_max_children_per_line(30)
-        self.grid.set_selection_mode(Gtk.SelectionMode.NONE)
-
-        create_thumbnails(common.settings.src_path)
-        self.files_dict = dict([(f, None) for f in os.listdir(common.settings.src_path)])
+        # Widgets are only created for thumbnails in sight, no matter how many pictures in the folder
+        self.grid = ThumbnailGrid()
 
-        src_pictures = get_files()
+        self.add(self.grid)
 
-        for file in src_pictures:
-            if file_allowed(file):
-                thumbnail = Thumbnail(common.settings.src_path, file)
-                common.thumbnails_list.append(thumbnail)
-                self.grid.add(thumbnail)
+        # Thumbnails in sight are created first: we follow scrolling and resizing
+        self.priority_source = None
+        self.get_vadjustment().connect('value-changed', self.schedule_prioritize)
+        self.grid.connect('size-allocate', self.schedule_prioritize)
 
-        self.add(self.grid)
+        self.pictures_dict = {}     # source path: Picture
+        self.generation = 0         # tells results of a background scan from those for the folder opened later
+        if not self.restore():
+            self.refresh()
 
     def refresh(self, create_thumbs=True):
-        self.files_dict = dict([(f, None) for f in os.listdir(common.settings.src_path)])
+        self.generation += 1
+        # The folder is walked once: the same snapshot serves sorting, thumbnails and tracking changes
+        self.files_dict = dict((f.path, f) for f in scan_src_path())   # source path: FileInfo
+        self.follow()
 
+        # Thumbnails not yet created will show a placeholder, until we receive them from the background task
+        self.populate()
         if create_thumbs:
-            create_thumbnails(common.settings.src_path)
+            self.create_thumbnails()
 
-        for thumbnail in common.thumbnails_list:
-            self.grid.remove(thumbnail)
-            thumbnail.destroy()
+    def follow(self):
+        if common.watcher:
+            try:
+                common.watcher.watch(common.settings.src_path)
+            except OSError:
+                # Too many subfolders to watch: start_tracking() will fall back to checking periodically
+                stop_tracking()
+                start_tracking()
+
+    def save_snapshot(self):
+        """
+        Saves the folder content as shown, for restore() on the next start
+        """
+        files = []
+        for picture in common.thumbnails_list:
+            file = self.files_dict[picture.source_path]
+            files.append([picture.filename, file.mtime, file.size, file.ext, picture.thumb_key])
+        save_json({'src_path': common.settings.src_path, 'sorting': common.settings.sorting, 'files': files},
+                  os.path.join(common.data_home, 'preview.json'))
+
+    def restore(self):
+        """
+        Shows the folder as it was on exit, without reading it; the real content gets compared in the background
+        :return: True if there was a snapshot for the current folder and sorting
+        """
+        snapshot_file = os.path.join(common.data_home, 'preview.json')
+        snapshot = load_json(snapshot_file) if os.path.isfile(snapshot_file) else None
+        if not snapshot or snapshot.get('src_path') != common.settings.src_path or snapshot.get(
+                'sorting') != common.settings.sorting or not os.path.isdir(common.settings.src_path):
+            return False
+        try:
+            self.files_dict = {}
+            common.thumbnails_list = []
+            failed = common.index.failures(common.settings.src_path)
+            for filename, mtime, size, ext, thumb_key in snapshot['files']:
+                picture = Picture(common.settings.src_path, filename, thumb_key=thumb_key, failed=failed)
+                common.thumbnails_list.append(picture)
+                self.files_dict[picture.source_path] = FileInfo(picture.source_path, mtime, size, ext)
+        except (KeyError, TypeError, ValueError):
+            return False
+        self.pictures_dict = dict((picture.source_path, picture) for picture in common.thumbnails_list)
+        self.grid.reload()
+        self.follow()
+
+        self.generation += 1
+        generation, folder = self.generation, common.settings.src_path
+
+        def scan():
+            try:
+                found = scan_folder(folder, common.allowed_file_types)
+            except OSError:
+                found = None
+            GLib.idle_add(self.on_restored_scanned, generation, found)
 
-        src_pictures = get_files()
+        threading.Thread(target=scan, daemon=True).start()
+        return True
 
-        for file in src_pictures:
-            if file_allowed(file):
-                thumbnail = Thumbnail(common.settings.src_path, file)
-                common.thumbnails_list.append(thumbnail)
-                self.grid.add(thumbnail)
+    def on_restored_scanned(self, generation, found):
+        if generation == self.generation:
+            if found is None:
+                self.refresh()
+            else:
+                found = dict((f.path, f) for f in found)
+                self.apply_changes(set(self.files_dict) | set(found), found, create_thumbs=False)
+                # Whatever changed: thumbnails may have been missing on exit, or failures be worth retrying
+                self.create_thumbnails()
+        return False
+
+    def create_thumbnails(self):
+        create_thumbnails(common.settings.src_path, list(self.files_dict.values()),
+                          on_created=self.on_thumbnail_created, on_finished=update_status_bar,
+                          on_draft=self.on_thumbnail_draft, on_failed=self.on_thumbnail_failed,
+                          on_reused=self.on_thumbnail_reused)
+        self.schedule_prioritize()
+
+    def populate(self):
+        src_pictures = get_files(self.files_dict.values())
+        indexed = common.index.folder(common.settings.src_path)
+        failed = common.index.failures(common.settings.src_path)
+
+        common.thumbnails_list = [Picture(common.settings.src_path, file, indexed, failed=failed)
+                                  for file in src_pictures]
+        self.pictures_dict = dict((picture.source_path, picture) for picture in common.thumbnails_list)
+        self.grid.reload()
+
+        # The status bar does not yet exist when the Preview is being created
+        if common.status_bar:
+            update_status_bar()
+
+    def update(self, paths=None):
+        """
+        Applies changes in the folder to the grid, without rebuilding it: only affected pictures get replaced.
+        Scroll position and selection remain untouched.
+        :param paths: changed files and subfolders, e.g. reported by the Watcher; None to check the whole folder
+        """
+        if paths is None or common.settings.src_path in paths:
+            try:
+                found = scan_folder(common.settings.src_path, common.allowed_file_types)
+                found = dict((f.path, f) for f in found)
+            except OSError:
+                # The folder is gone
+                self.refresh()
+                return
+            paths = set(self.files_dict) | set(found)
+        else:
+            found = {}
+            candidates = set(paths)
+            for path in paths:
+                if os.path.isdir(path):
+                    try:
+                        found.update((f.path, f) for f in scan_folder(path, common.allowed_file_types))
+                    except OSError:
+                        pass
+                else:
+                    info = file_info(path, common.allowed_file_types)
+                    if info:
+                        found[path] = info
+                # Files inside a subfolder, which might be gone
+                prefix = os.path.join(path, '')
+                candidates.update(p for p in self.files_dict if p.startswith(prefix))
+            paths = candidates | set(found)
+        self.apply_changes(paths, found)
+
+    def apply_changes(self, paths, found, create_thumbs=True):
+        """
+        :param paths: source paths to check
+        :param found: dictionary {source path: FileInfo} of these present on disk
+        :param create_thumbs: start creating thumbnails for added files
+        :return: True if anything changed
+        """
+        removed = [p for p in paths if p in self.files_dict and self.files_dict[p] != found.get(p)]
+        added = [found[p] for p in paths if p in found and self.files_dict.get(p) != found[p]]
+        if not removed and not added:
+            return False
+
+        selected = common.selected_wallpaper.source_path if common.selected_wallpaper else None
+        for path in removed:
+            picture = self.pictures_dict.pop(path, None)
+            if picture:
+                common.thumbnails_list.remove(picture)
+            del self.files_dict[path]
+
+        indexed = dict((f.path, common.index.get(f.path)) for f in added)
+        # A broken file may come back unchanged (e.g. restored from trash): it won't be tried again
+        failed = common.index.failures(common.settings.src_path) if added else None
+        start = len(common.settings.src_path.rstrip('/')) + 1
+        for file in added:
+            position = self.insert_position(file)
+            self.files_dict[file.path] = file
+            picture = Picture(common.settings.src_path, file.path[start:], indexed, failed=failed)
+            common.thumbnails_list.insert(position, picture)
+            self.pictures_dict[file.path] = picture
+        self.grid.reload()
+
+        if selected in removed:
+            if selected in self.pictures_dict:
+                # Modified, but still there
+                select_picture(self.pictures_dict[selected])
+            else:
+                clear_wallpaper_selection()
 
-                thumbnail.show_all()
-                thumbnail.toolbar.hide()
+        if added and create_thumbs:
+            self.create_thumbnails()
+        else:
+            update_status_bar()
+        return True
 
-        update_status_bar()
+    def insert_position(self, file):
+        """
+        :param file: FileInfo not yet shown
+        :return: index in common.thumbnails_list to keep the sorting order
+        """
+        key, descending = sort_key(file), sort_descending()
+        low, high = 0, len(common.thumbnails_list)
+        while low < high:
+            middle = (low + high) // 2
+            other = sort_key(self.files_dict[common.thumbnails_list[middle].source_path])
+            if (other < key) if descending else (other > key):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def schedule_prioritize(self, *args):
+        # Scrolling emits plenty of signals; we only care where it stops
+        if common.thumbnails_task and not self.priority_source:
+            self.priority_source = GLib.timeout_add(100, self.prioritize)
+
+    def prioritize(self):
+        self.priority_source = None
+        if common.thumbnails_task:
+            first, last = self.grid.visible_range(screens=2)
+            common.thumbnails_task.prioritize([p.source_path for p in common.thumbnails_list[first:last]])
+        return False
+
+    def on_thumbnail_draft(self, path, pixels, width, height):
+        picture = self.pictures_dict.get(path)
+        if picture:
+            pixbuf_cache_put(picture.thumb_key, pixels_pixbuf(pixels, width, height))
+            thumbnail = self.grid.shown.get(picture)
+            if thumbnail:
+                thumbnail.load_image()
+
+    def on_thumbnail_failed(self, failure):
+        picture = self.pictures_dict.get(failure.path)
+        if picture:
+            picture.failure = failure
+            forget_pixbuf(picture.thumb_key)
+            thumbnail = self.grid.shown.get(picture)
+            if thumbnail:
+                thumbnail.load_image()
+
+    def on_thumbnail_reused(self, entry):
+        picture = self.pictures_dict.get(entry.path)
+        if picture:
+            # The placeholder, kept under the key guessed from the path
+            forget_pixbuf(picture.thumb_key)
+            picture.info = entry
+            picture.failure = None
+            thumbnail = self.grid.shown.get(picture)
+            if thumbnail:
+                thumbnail.load_image()
+
+    def on_thumbnail_created(self, entry, pixels, width, height):
+        picture = self.pictures_dict.get(entry.path)
+        if picture:
+            # Forget the draft, which may have been kept under the key guessed before the entry was known
+            forget_pixbuf(picture.thumb_key)
+            picture.info = entry
+            picture.failure = None
+            # The thumbnail file might have been there, and got refreshed
+            forget_pixbuf(picture.thumb_key)
+            thumbnail = self.grid.shown.get(picture)
+            if thumbnail:
+                # Straight from memory: the thumbnail may not have been stored yet
+                pixbuf_cache_put(picture.thumb_key, pixels_pixbuf(pixels, width, height))
+                thumbnail.load_image()
+
+
+class Picture(object):
+    """
+    An image in the preview. The grid shows it with a Thumbnail widget, but only while in sight.
+    """
+    def __init__(self, folder, filename, indexed=None, thumb_key=None, failed=None):
+        self.folder = folder
+        self.filename = filename
+        self.source_path = os.path.join(folder, filename)
+        self.default_key = thumb_key
+        # `indexed` comes from common.index.folder(); we only check files for what's missing there
+        self.info = indexed.get(self.source_path) if indexed else None  # IndexEntry, if any
+        # `failed` comes from common.index.failures()
+        self.failure = failed.get(self.source_path) if failed else None  # Failure, if we could not decode the file
+
+    @property
+    def thumb_key(self):
+        # With content-based keys, we can't tell the key from the path: the index knows it
+        if self.info:
+            return self.info.thumb_key
+        if not self.default_key:
+            self.default_key = hash_name(self.source_path)
+        return self.default_key
+
+    @property
+    def thumb_path(self):
+        return "{}.png".format(os.path.join(common.thumb_dir, self.thumb_key))
+
+    @property
+    def thumb_file(self):
+        """
+        Thumbnail as a PNG file, for things which need a file. With the 'pack' store, it's exported on demand.
+        """
+        if self.thumb_key in common.pack and not os.path.isfile(self.thumb_path):
+            common.pack.export_png(self.thumb_key, self.thumb_path)
+        return self.thumb_path
+
+
+class ThumbnailGrid(Gtk.Layout):
+    """
+    Lays common.thumbnails_list out in rows, like Gtk.FlowBox would, but only creates Thumbnail widgets for rows
+    in sight, and a few around. Widgets scrolled out of sight are reused for pictures scrolled in.
+    """
+    margin_rows = 2
+
+    def __init__(self):
+        super().__init__()
+        self.tile_size = None       # (width, height) of a Thumbnail, measured once realized
+        self.cols = 1
+        self.natural_height = 0
+        self.shown = {}             # Picture: Thumbnail
+        self.positions = {}         # Thumbnail: (x, y)
+        self.spare = []             # Thumbnail widgets not in use
+        self.layout_source = None
+        self.connect('size-allocate', self.on_size_allocate)
+        self.connect('notify::vadjustment', self.on_vadjustment)
+
+    def do_get_preferred_height(self):
+        # Lets the ScrolledWindow propagate our natural height, as it did with the FlowBox
+        return 0, self.natural_height
+
+    def on_vadjustment(self, *args):
+        if self.get_vadjustment():
+            self.get_vadjustment().connect('value-changed', lambda adjustment: self.update_view())
+
+    def on_size_allocate(self, widget, allocation):
+        # We must not resize anything while being allocated: let's do it as soon as Gtk is done
+        if not self.layout_source:
+            self.layout_source = GLib.idle_add(self.on_layout)
+
+    def on_layout(self):
+        self.layout_source = None
+        if not self.tile_size:
+            self.measure()
+        width = self.get_allocated_width()
+        cols = max(1, width // self.tile_size[0])
+        if cols != self.cols or self.get_size()[0] != width:
+            self.cols = cols
+            self.reload()
+        else:
+            self.update_view()
+        return False
+
+    def measure(self):
+        probe = self.get_thumbnail()
+        probe.bind(Picture(common.settings.src_path, 'x' * 30))
+        if common.settings.image_menu_button:
+            probe.toolbar.show_all()
+        width, height = probe.get_preferred_width()[1], probe.get_preferred_height()[1]
+        self.release(probe)
+        self.tile_size = (width, height)
+
+    def reset(self):
+        """
+        Call if the Thumbnail size may have changed
+        """
+        self.tile_size = None
+        self.queue_resize()
+
+    def reload(self):
+        """
+        Call after common.thumbnails_list changed
+        """
+        if not self.tile_size:
+            # Not yet realized, we'll get back here on size-allocate
+            return
+        width = self.get_allocated_width()
+        rows = (len(common.thumbnails_list) + self.cols - 1) // self.cols
+        height = rows * self.tile_size[1]
+        self.set_size(width, height)
+        if height != self.natural_height:
+            self.natural_height = height
+            self.queue_resize()
+        self.update_view(rebind=True)
+
+    def visible_range(self, screens=1):
+        """
+        :param screens: how many screenfuls to include, starting from the visible one
+        :return: (first, last) index range in common.thumbnails_list
+        """
+        if not self.tile_size:
+            return 0, 0
+        adjustment = self.get_vadjustment()
+        top = adjustment.get_value()
+        bottom = top + adjustment.get_page_size() * screens
+        first = int(top // self.tile_size[1]) * self.cols
+        last = (int(bottom // self.tile_size[1]) + 1) * self.cols
+        return first, min(last, len(common.thumbnails_list))
+
+    def update_view(self, rebind=False):
+        """
+        Binds Thumbnail widgets to pictures in sight, and releases the rest
+        :param rebind: True if pictures might have been replaced, e.g. after the folder has changed
+        """
+        if not self.tile_size:
+            return
+        first, last = self.visible_range()
+        margin = self.margin_rows * self.cols
+        first, last = max(0, first - margin), min(len(common.thumbnails_list), last + margin)
+        wanted = common.thumbnails_list[first:last]
+
+        wanted_set = set(wanted)
+        for picture in list(self.shown):
+            if picture not in wanted_set:
+                self.release(self.shown.pop(picture))
+
+        cell_width = self.get_allocated_width() // self.cols
+        for i, picture in enumerate(wanted, start=first):
+            thumbnail = self.shown.get(picture)
+            if not thumbnail:
+                thumbnail = self.get_thumbnail()
+                thumbnail.bind(picture)
+                self.shown[picture] = thumbnail
+            elif rebind:
+                thumbnail.bind(picture)
+            position = ((i % self.cols) * cell_width, (i // self.cols) * self.tile_size[1])
+            if self.positions.get(thumbnail) != position:
+                self.move(thumbnail, *position)
+                self.positions[thumbnail] = position
+            thumbnail.set_size_request(cell_width, -1)
+
+    def get_thumbnail(self):
+        if self.spare:
+            thumbnail = self.spare.pop()
+        else:
+            thumbnail = Thumbnail()
+            self.put(thumbnail, 0, 0)
+            self.positions[thumbnail] = (0, 0)
+        thumbnail.show()
+        return thumbnail
+
+    def release(self, thumbnail):
+        thumbnail.hide()
+        thumbnail.picture = None
+        self.spare.append(thumbnail)
+
+    def show_selection(self):
+        for thumbnail in self.shown.values():
+            thumbnail.show_selection()
 
 
 class Thumbnail(Gtk.VBox):
-    def __init__(self, folder, filename):
+    """
+    Shows a Picture in the ThumbnailGrid. Widgets are reused for other pictures while scrolling, see bind().
+    """
+    def __init__(self):
         super().__init__()
+        self.picture = None
         self.toolbar = ImageToolbar(self)
         self.add(self.toolbar)
 
@@ -166,31 +593,49 @@ class Thumbnail(Gtk.VBox):
         self.image_button.set_property("name", "thumb-btn")
         self.image_button.set_always_show_image(True)
 
-        self.folder = folder
-        self.filename = filename
-        self.source_path = os.path.join(folder, filename)
-
         self.img = Gtk.Image()
-        self.thumb_file = "{}.png".format(os.path.join(common.thumb_dir, hash_name(self.source_path)))
-        self.img.set_from_file(self.thumb_file)
-
         self.image_button.set_image(self.img)
         self.image_button.set_image_position(2)  # TOP
         self.image_button.set_tooltip_text(common.lang['thumbnail_tooltip'])
 
-        if len(filename) > 30:
-            filename = '…{}'.format(filename[-28::])
-        self.image_button.set_label(filename)
-        self.selected = False
-
         # self.connect('clicked', self.on_button_press)
         self.image_button.connect('button-press-event', self.on_image_button_press)
 
         self.add(self.image_button)
+        self.image_button.show_all()
+        # The grid decides which thumbnails to show; window.show_all() must not reveal spare ones
+        self.set_no_show_all(True)
+
+    def bind(self, picture):
+        self.picture = picture
+        self.load_image()
+
+        filename = picture.filename
+        if len(filename) > 30:
+            filename = '…{}'.format(filename[-28::])
+        self.image_button.set_label(filename)
+        self.show_selection()
+
+    def load_image(self):
+        pixbuf = thumbnail_pixbuf(self.picture)
+        if pixbuf is None:
+            pixbuf = broken_pixbuf() if self.picture.failure else placeholder_pixbuf()
+        set_thumbnail_pixbuf(self.img, pixbuf)
+        self.image_button.set_tooltip_text(self.picture.failure.error if self.picture.failure else
+                                           common.lang['thumbnail_tooltip'])
+
+    def show_selection(self):
+        if self.picture is not None and self.picture is common.selected_wallpaper:
+            self.image_button.set_property("name", "thumb-btn-selected")
+            if common.settings.image_menu_button:
+                self.toolbar.show_all()
+        else:
+            self.image_button.set_property("name", "thumb-btn")
+            self.toolbar.hide()
 
     def on_image_button_press(self, button, event):
 
-        self.select(button)
+        select_picture(self.picture)
 
         if event.type == Gdk.EventType._2BUTTON_PRESS:
             on_thumb_double_click(button)
@@ -200,34 +645,190 @@ class Thumbnail(Gtk.VBox):
     def on_menu_button_press(self, button):
         show_image_menu(self)
 
-    def select(self, thumbnail):
-        if common.split_button:
-            common.split_button.set_sensitive(True)
 
-        common.apply_to_all_button.set_sensitive(True)
+def select_picture(picture):
+    if common.split_button:
+        common.split_button.set_sensitive(True)
+
+    common.apply_to_all_button.set_sensitive(True)
+
+    common.selected_wallpaper = picture
+    common.preview.grid.show_selection()
+
+    # Image dimensions come from the index; we only need to open the file if not known yet
+    if not picture.info:
+        # Not looked up, if restored from the snapshot
+        picture.info = common.index.get(picture.source_path)
+    if not picture.info or picture.info.width is None:
+        with Image.open(picture.source_path) as img:
+            width, height, fmt, orientation = image_info(img)
+        common.index.set_image_info(picture.source_path, width, height, fmt, orientation)
+        if picture.info:
+            picture.info = picture.info._replace(width=width, height=height, format=fmt, orientation=orientation)
+    else:
+        width, height = picture.info.width, picture.info.height
+
+    filename = picture.filename
+    if len(filename) > 30:
+        filename = '…{}'.format(filename[-28::])
+    common.selected_picture_label.set_text("{} ({} x {})".format(filename, width, height))
+
+
+class PixbufCache(object):
+    """
+    Decoded thumbnails, least recently used dropped first, so that scrolling back and forth does not decode
+    them again, while memory use stays within the budget
+    """
+    def __init__(self, budget):
+        """
+        :param budget: bytes
+        """
+        self.budget = budget
+        self.used = 0
+        self.pixbufs = OrderedDict()    # thumbnail key: GdkPixbuf.Pixbuf
+
+    def get(self, picture):
+        """
+        :return: GdkPixbuf.Pixbuf, or None if the thumbnail does not yet exist
+        """
+        key = picture.thumb_key
+        pixbuf = self.pixbufs.get(key)
+        if pixbuf is not None:
+            self.pixbufs.move_to_end(key)
+            return pixbuf
+        packed = common.pack.get(key)
+        if packed:
+            pixbuf = pixels_pixbuf(*packed)
+        elif picture.info or os.path.isfile(picture.thumb_path):
+            try:
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file(picture.thumb_path)
+            except GLib.Error:
+                return None
+        else:
+            return None
+        pixbuf = self.put(key, pixbuf)
+        return pixbuf
+
+    def put(self, key, pixbuf):
+        """
+        :param pixbuf: master thumbnail, which we keep scaled to the size it's displayed at
+        :return: the scaled pixbuf
+        """
+        pixbuf = display_pixbuf(pixbuf)
+        self.forget(key)
+        self.pixbufs[key] = pixbuf
+        self.used += pixbuf.get_byte_length()
+        # Pixbufs still shown are referenced by their Gtk.Image, we only release ours
+        while self.used > self.budget and len(self.pixbufs) > 1:
+            self.used -= self.pixbufs.popitem(last=False)[1].get_byte_length()
+        return pixbuf
+
+    def forget(self, key):
+        pixbuf = self.pixbufs.pop(key, None)
+        if pixbuf is not None:
+            self.used -= pixbuf.get_byte_length()
+
+
+def pixels_pixbuf(pixels, width, height):
+    """
+    :param pixels: raw RGB bytes, as kept in the pack and returned by the thumbnail engine
+    """
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(pixels), GdkPixbuf.Colorspace.RGB, False, 8, width, height,
+                                           width * 3)
+
+
+def get_pixbuf_cache():
+    global pixbuf_cache
+    if pixbuf_cache is None:
+        pixbuf_cache = PixbufCache(common.settings.thumbnail_cache_mb * 1024 * 1024)
+    return pixbuf_cache
 
-        self.image_button.selected = True
-        common.selected_wallpaper = self
-        deselect_all()
-        if common.settings.image_menu_button:
-            self.toolbar.show_all()
-        thumbnail.set_property("name", "thumb-btn-selected")
 
-        with Image.open(self.source_path) as img:
-            filename = self.filename
-            if len(filename) > 30:
-                filename = '…{}'.format(filename[-28::])
-            common.selected_picture_label.set_text("{} ({} x {})".format(filename, img.size[0], img.size[1]))
+def thumbnail_pixbuf(picture):
+    return get_pixbuf_cache().get(picture)
 
-    def deselect(self, thumbnail):
-        self.selected = False
-        self.toolbar.hide()
-        thumbnail.image_button.set_property("name", "thumb-btn")
 
+def pixbuf_cache_put(key, pixbuf):
+    get_pixbuf_cache().put(key, pixbuf)
 
-def deselect_all():
-    for thumbnail in common.thumbnails_list:
-        thumbnail.deselect(thumbnail)
+
+def forget_pixbuf(key):
+    if pixbuf_cache is not None:
+        pixbuf_cache.forget(key)
+
+
+def placeholder_pixbuf():
+    """
+    Shown in place of thumbnails not yet created. One pixbuf is enough for all of them.
+    """
+    global placeholder
+    width, height = display_size()
+    if placeholder is None or placeholder.get_width() != width:
+        placeholder = GdkPixbuf.Pixbuf.new_from_file_at_scale(os.path.join(dir_name, 'images/squares.jpg'),
+                                                              width, height, False)
+    return placeholder
+
+
+def broken_pixbuf():
+    """
+    The placeholder with the "broken image" badge. Again, one pixbuf is enough for all of them.
+    """
+    global broken
+    background = placeholder_pixbuf()
+    if broken is None or broken.get_width() != background.get_width():
+        broken = background.copy()
+        size = min(background.get_width(), background.get_height()) // 3
+        try:
+            badge = Gtk.IconTheme.get_default().load_icon('image-missing', size, Gtk.IconLookupFlags.FORCE_SIZE)
+        except GLib.Error:
+            badge = None
+        if badge:
+            x = (background.get_width() - badge.get_width()) // 2
+            y = (background.get_height() - badge.get_height()) // 2
+            badge.composite(broken, x, y, badge.get_width(), badge.get_height(), x, y, 1, 1, InterpType.BILINEAR, 255)
+    return broken
+
+
+def display_size():
+    """
+    :return: thumbnail size in device pixels: twice the thumbnail size on HiDPI (scale 2) displays
+    """
+    scale = common.settings.display_scale
+    return common.settings.thumb_width * scale, common.settings.thumb_height * scale
+
+
+def display_pixbuf(pixbuf):
+    """
+    Scales the thumbnail, as stored at the master size, to the size it's displayed at
+    """
+    width, height = display_size()
+    if pixbuf.get_width() != width or pixbuf.get_height() != height:
+        pixbuf = pixbuf.scale_simple(width, height, InterpType.BILINEAR)
+    return pixbuf
+
+
+def set_thumbnail_pixbuf(img, pixbuf):
+    """
+    :param img: Gtk.Image
+    :param pixbuf: GdkPixbuf.Pixbuf of display_size()
+    """
+    scale = common.settings.display_scale
+    if scale > 1:
+        # A pixbuf would be shown pixel for pixel, that is twice too big; a surface knows its scale
+        img.set_from_surface(Gdk.cairo_surface_create_from_pixbuf(pixbuf, scale, None))
+    else:
+        img.set_from_pixbuf(pixbuf)
+
+
+def set_thumbnail_file(img, path):
+    """
+    Shows a thumbnail PNG file (e.g. exported from the pack at the master size) in the thumbnail size
+    """
+    try:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+    except GLib.Error:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(dir_name, 'images/empty.png'))
+    set_thumbnail_pixbuf(img, display_pixbuf(pixbuf))
 
 
 class ImageToolbar(Gtk.HBox):
@@ -271,13 +872,15 @@ class DisplayBox(Gtk.Box):
         self.xrandr_idx = xrandr_idx
         self.include = True
 
+        thumb_key = os.path.splitext(os.path.basename(thumb))[0] if thumb else None
+        if thumb and not os.path.isfile(thumb) and thumb_key in common.pack:
+            # Exported from the pack, and removed since
+            common.pack.export_png(thumb_key, thumb)
+        self.img = Gtk.Image()
         if thumb and os.path.isfile(thumb):
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumb)
+            set_thumbnail_file(self.img, thumb)
         else:
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(dir_name, 'images/empty.png'))
-        pixbuf = pixbuf.scale_simple(common.settings.thumb_size[0], common.settings.thumb_size[1], InterpType.BILINEAR)
-
-        self.img = Gtk.Image.new_from_pixbuf(pixbuf)
+            set_thumbnail_file(self.img, os.path.join(dir_name, 'images/empty.png'))
 
         self.select_button = Gtk.Button()
         self.select_button.set_always_show_image(True)
@@ -364,7 +967,7 @@ class DisplayBox(Gtk.Box):
 
     def on_select_button(self, button):
         if common.selected_wallpaper:
-            self.img.set_from_file(common.selected_wallpaper.thumb_file)
+            set_thumbnail_file(self.img, common.selected_wallpaper.thumb_file)
             self.wallpaper_path = common.selected_wallpaper.source_path
             self.thumbnail_path = common.selected_wallpaper.thumb_file
             button.set_property("name", "display-btn-selected")
@@ -397,7 +1000,7 @@ class DisplayBox(Gtk.Box):
     def on_flip_button(self, button):
         # convert images and get (thumbnail path, flipped image path)
         images = flip_selected_wallpaper()
-        self.img.set_from_file(images[0])
+        set_thumbnail_file(self.img, images[0])
         self.wallpaper_path = images[1]
         self.thumbnail_path = images[0]
         self.flip_button.set_sensitive(False)
@@ -577,7 +1180,7 @@ def on_split_button(button):
         for box in common.display_boxes_list:
             if box.include:
                 box.wallpaper_path = paths[i][0]
-                box.img.set_from_file(paths[i][1])
+                set_thumbnail_file(box.img, paths[i][1])
                 box.thumbnail_path = paths[i][1]
                 i += 1
 
@@ -601,6 +1204,8 @@ def open_with(item, opener):
 
 def clear_wallpaper_selection():
     common.selected_wallpaper = None
+    if common.preview:
+        common.preview.grid.show_selection()
     common.selected_picture_label.set_text(common.lang['no_picture_selected'])
     if common.split_button:
         common.split_button.set_sensitive(False)
@@ -652,11 +1257,17 @@ def on_about_button(button):
 
 
 def move_to_trash(widget):
-    send2trash(common.selected_wallpaper.source_path)
-    if os.path.isfile(common.selected_wallpaper.thumb_file):
-        send2trash(common.selected_wallpaper.thumb_file)
+    path = common.selected_wallpaper.source_path
+    thumb_key, thumb_path = common.selected_wallpaper.thumb_key, common.selected_wallpaper.thumb_path
+    send2trash(path)
+    common.index.remove([path])
+    # With content-based keys, copies of the file share the thumbnail
+    if not common.index.find_key(thumb_key):
+        if os.path.isfile(thumb_path):
+            send2trash(thumb_path)
+        common.pack.remove([thumb_key])
     clear_wallpaper_selection()
-    common.preview.refresh()
+    common.preview.update([path])
 
 
 def show_image_menu(widget, event=None, parent=None, from_toolbar=False):
@@ -795,9 +1406,7 @@ def on_refresh_clicked(button):
 
 
 def generate_palette(item, thumb_file, filename, image_path, num_colors):
-    color_thief = ColorThief(image_path)
-    # dominant = color_thief.get_color(quality=10)
-    palette = color_thief.get_palette(color_count=num_colors, quality=common.settings.palette_quality)
+    palette = imaging.palette(image_path, num_colors, common.settings.palette_quality)
     if common.cpd:
         common.cpd.close()
     common.cpd = ColorPaletteDialog(thumb_file, filename, palette)
@@ -893,7 +1502,7 @@ class GUI:
         window.add(main_box)
         window.show_all()
 
-        # This contains a Gtk.ScrolledWindow with Gtk.Grid() inside, filled with ThumbButton(Gtk.Button) instances
+        # This contains a Gtk.ScrolledWindow with the ThumbnailGrid inside, showing Thumbnail widgets in sight
         common.preview = Preview()
 
         main_box.pack_start(common.preview, False, False, 0)
@@ -1082,7 +1691,6 @@ class GUI:
         main_box.add(status_box)
 
         window.show_all()
-        deselect_all()
 
         common.progress_bar.hide()
 
@@ -1192,9 +1800,8 @@ def get_dominant_from_area():
 
     res = subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL).returncode
     if res == 0:
-        color_thief = ColorThief(os.path.join(common.tmp_dir, 'area.png'))
         try:
-            dominant = color_thief.get_color(quality=common.settings.palette_quality)
+            dominant = imaging.dominant_color(os.path.join(common.tmp_dir, 'area.png'), common.settings.palette_quality)
         except:
             pass
 
@@ -1255,16 +1862,19 @@ def switch_image_menu_button(item):
     else:
         common.settings.image_menu_button = False
         common.settings.save()
+    # Thumbnails need to make room for the toolbar, or may shrink
+    common.preview.grid.reset()
 
 
 def switch_tracking_files(item):
     if item.get_active():
         common.settings.track_files = True
         common.settings.save()
-        GLib.timeout_add_seconds(common.settings.tracking_interval_seconds, track_changes)
+        start_tracking()
     else:
         common.settings.track_files = False
         common.settings.save()
+        stop_tracking()
     if common.indicator:
         common.indicator.switch_indication(item)
 
@@ -1282,7 +1892,8 @@ class ColorPaletteDialog(Gtk.Window):
     def __init__(self, thumb_file, filename, palette):
         super().__init__()
 
-        self.image = Gtk.Image.new_from_file(thumb_file)
+        self.image = Gtk.Image()
+        set_thumbnail_file(self.image, thumb_file)
         self.label = Gtk.Label()
         self.label.set_text(filename)
         self.label.set_property('name', 'image-label')
@@ -1748,7 +2359,7 @@ def on_thumb_double_click(button):
 def apply_to_all_swaybg(item, mode):
     # Firstly we need to set the selected image thumbnail to all previews currently visible
     for box in common.display_boxes_list:
-        box.img.set_from_file(common.selected_wallpaper.thumb_file)
+        set_thumbnail_file(box.img, common.selected_wallpaper.thumb_file)
         box.wallpaper_path = common.selected_wallpaper.source_path
         box.thumbnail_path = common.selected_wallpaper.thumb_file
 
@@ -1758,7 +2369,7 @@ def apply_to_all_swaybg(item, mode):
 def apply_to_all_feh(item, mode):
     # Firstly we need to set the selected image thumbnail to all previews currently visible
     for box in common.display_boxes_list:
-        box.img.set_from_file(common.selected_wallpaper.thumb_file)
+        set_thumbnail_file(box.img, common.selected_wallpaper.thumb_file)
         box.wallpaper_path = common.selected_wallpaper.source_path
         box.thumbnail_path = common.selected_wallpaper.thumb_file
 
@@ -1771,15 +2382,47 @@ def print_help():
     print('[-l] | [--lang] <ln_LN> \t force a Locale (de_DE, en_US, fr_FR, pl_PL)')
     print('[-c] | [--clear]\t\t Clear unused thumbnails')
     print('[-a] | [--clear-all]\t\t clear All thumbnails\n')
+    print('[--prewarm] <DIR>...\t\t create thumbnails for folders (recursively), without opening a window\n')
     print('[-v] | [--version]\t\t display Version information\n')
 
 
+def start_tracking():
+    """
+    We follow the current folder with inotify, and only check it every `tracking_interval_seconds` if not available
+    """
+    if common.watcher or common.tracking_timer:
+        return
+    try:
+        common.watcher = Watcher(on_files_changed, common.allowed_file_types)
+        common.watcher.watch(common.settings.src_path)
+        log('Tracking files with inotify', common.INFO)
+    except OSError as e:
+        if common.watcher:
+            common.watcher.close()
+            common.watcher = None
+        log('inotify unavailable ({}), checking files every {} seconds'.format(
+            e, common.settings.tracking_interval_seconds), common.WARNING)
+        common.tracking_timer = GLib.timeout_add_seconds(common.settings.tracking_interval_seconds, track_changes)
+
+
+def stop_tracking():
+    if common.watcher:
+        common.watcher.close()
+        common.watcher = None
+    if common.tracking_timer:
+        GLib.source_remove(common.tracking_timer)
+        common.tracking_timer = None
+
+
+def on_files_changed(paths):
+    if common.preview:
+        common.preview.update(paths)
+
+
 def track_changes():
     if common.preview and common.settings.src_path:
-        files_dict = dict([(f, None) for f in os.listdir(common.settings.src_path)])
-        if not files_dict == common.preview.files_dict:
-            common.preview.refresh()
-    return common.settings.track_files
+        common.preview.update()
+    return True
 
 
 class Indicator(object):
@@ -1947,7 +2590,7 @@ def main():
     common.cols = len(common.displays) if len(common.displays) > common.settings.columns else common.settings.columns
 
     if common.settings.track_files:
-        GLib.timeout_add_seconds(common.settings.tracking_interval_seconds, track_changes)
+        start_tracking()
     if common.env['app_indicator']:
         common.indicator = Indicator()
 
@@ -1970,6 +2613,14 @@ def main():
             app = GUI(int(common.screen_h * 0.95))  # sway
 
     Gtk.main()
+    if common.preview:
+        common.preview.save_snapshot()
+    thumbnailer.shutdown()
+    common.writer.close()
+    if common.pack.garbage() > os.path.getsize(common.pack.pack_file) // 2:
+        common.pack.compact()
+    common.pack.close()
+    common.index.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+`azote --prewarm DIR...`: creates thumbnails and image metadata for folders, without opening a window
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+Meant for a systemd user timer, or for preparing shared wallpaper folders (e.g. /usr/share/backgrounds/nwg-shell)
+at image-provisioning time. Does not import Gtk: it may run where no display is available.
+"""
+import os
+import sys
+import json
+import time
+import pickle
+
+from azote import common
+from azote.core import thumbnailer
+from azote.core.index import Index
+from azote.core.store import Pack, Writer
+from azote.core.scan import scan_folder, find_thumbnail_jobs, store_result
+
+# azoterc values we need, as Settings.load_rc() defaults them
+DEFAULTS = {'thumb_width': 240, 'thumbnail_master_width': 0, 'thumbnail_workers': 0, 'thumbnail_backend': 'auto',
+            'max_decode_pixels': 50000000, 'thumbnail_store': 'pack', 'thumbnail_keys': 'path',
+            'freedesktop_thumbnails': 'read'}
+
+
+class StoredSettings(object):
+    """
+    Stands in for tools.Settings when reading settings.pkl, as importing tools would import Gtk
+    """
+    pass
+
+
+class SettingsUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == 'azote.tools' and name == 'Settings':
+            return StoredSettings
+        return super().find_class(module, name)
+
+
+def load_rc(config_home):
+    rc = dict(DEFAULTS)
+    try:
+        with open(os.path.join(config_home, 'azoterc'), 'r') as f:
+            rc.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print('azoterc error: {}, using defaults'.format(e), file=sys.stderr)
+    for key in ('thumb_width', 'thumbnail_master_width', 'thumbnail_workers', 'max_decode_pixels'):
+        rc[key] = int(rc[key])
+    return rc
+
+
+def master_width(rc, data_home):
+    """
+    Thumbnails must be created at the master width the GUI uses, or it would consider them out of date.
+    The GUI stores it, multiplied by the display scale we can not learn here: we only count on azoterc without it.
+    """
+    try:
+        with open(os.path.join(data_home, 'settings.pkl'), 'rb') as f:
+            stored = SettingsUnpickler(f).load()
+    except Exception:
+        stored = None
+    width = getattr(stored, 'master_width', None)
+    if width:
+        return width
+    if rc['thumbnail_master_width']:
+        return max(rc['thumbnail_master_width'], rc['thumb_width'])
+    # As the GUI's default, without the display scale
+    return rc['thumb_width'] * 2
+
+
+def prewarm(folder, rc, thumb_size, workers):
+    """
+    :return: (images found, thumbnails created, failures)
+    """
+    started = time.time()
+    files = scan_folder(folder, common.allowed_file_types)
+    jobs = find_thumbnail_jobs(common.writer, folder, files, common.thumb_dir, thumb_size, rc['thumbnail_backend'],
+                               rc['max_decode_pixels'], rc['thumbnail_store'], rc['thumbnail_keys'],
+                               rc['freedesktop_thumbnails'])
+    # Nobody to show drafts to
+    jobs = [job._replace(embedded=False) for job in jobs]
+    failed = []
+
+    def on_result(result, done, total):
+        store_result(common.writer, result)
+        if result.error:
+            failed.append(result.job.in_path)
+        if done % 100 == 0 and done < total:
+            print('{}: {} of {}'.format(folder, done, total), file=sys.stderr)
+
+    task = thumbnailer.Task(lambda: jobs, workers, on_result=on_result).start()
+    task.join()
+    common.writer.flush()
+    common.index.flush()
+
+    elapsed = max(time.time() - started, 0.001)
+    print('{}: {} images, {} skipped (up to date, or failed before), {} created, {} failed in {:.1f} s '
+          '({:.1f} files/s)'.format(folder, len(files), len(files) - len(jobs), len(jobs) - len(failed), len(failed),
+                                    elapsed, len(files) / elapsed))
+    for path in failed:
+        print('  failed: {}'.format(path), file=sys.stderr)
+    return len(files), len(jobs) - len(failed), len(failed)
+
+
+def main(folders):
+    """
+    :param folders: paths from the command line
+    :return: exit code
+    """
+    xdg_config_home = os.getenv('XDG_CONFIG_HOME')
+    config_home = os.path.join(xdg_config_home, "azote") if xdg_config_home else os.path.join(
+        os.getenv("HOME"), ".config/azote")
+    xdg_data_home = os.getenv('XDG_DATA_HOME')
+    common.data_home = xdg_data_home if xdg_data_home else os.path.join(os.getenv("HOME"), ".local/share/azote")
+    common.thumb_dir = os.path.join(common.data_home, "thumbnails")
+    os.makedirs(common.thumb_dir, exist_ok=True)
+
+    rc = load_rc(config_home)
+    width = master_width(rc, common.data_home)
+    thumb_size = (width, int(width * 135 / 240))
+    workers = thumbnailer.worker_count(rc['thumbnail_workers'])
+
+    common.index = Index(os.path.join(common.data_home, "thumbnails.db"))
+    common.pack = Pack(os.path.join(common.data_home, "thumbnails.pack"), common.index)
+    common.writer = Writer(common.pack, common.index)
+
+    started = time.time()
+    exit_code = 0
+    total = created = 0
+    try:
+        for folder in folders:
+            folder = os.path.abspath(folder)
+            try:
+                found, made, failed = prewarm(folder, rc, thumb_size, workers)
+            except OSError as e:
+                print('{}: {}'.format(folder, e), file=sys.stderr)
+                exit_code = 1
+                continue
+            total += found
+            created += made
+    finally:
+        thumbnailer.shutdown()
+        common.writer.close()
+        common.pack.close()
+        common.index.close()
+
+    if len(folders) > 1:
+        elapsed = max(time.time() - started, 0.001)
+        print('Total: {} images, {} created in {:.1f} s ({:.1f} files/s)'.format(total, created, elapsed,
+                                                                               total / elapsed))
+    return exit_code
@@ -11,7 +11,6 @@ Project: https://github.com/nwg-piotr/azote
 License: GPL3
 """
 import os
-import glob
 import hashlib
 import logging
 import pickle
@@ -42,9 +41,14 @@ except ImportError:
 import gi
 
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, GdkPixbuf, GLib
+from gi.repository import Gdk, GdkPixbuf, GLib
 
 from azote import common
+from azote.core import thumbnailer, backends, imaging
+from azote.core.thumbnailer import expand_img
+from azote.core.index import Index
+from azote.core.store import Pack, Writer
+from azote.core.scan import scan_folder, find_thumbnail_jobs, store_result
 
 dir_name = os.path.dirname(__file__)
 
@@ -384,6 +388,11 @@ def set_env(__version__, lang_from_args=None):
     if not os.path.isdir(common.thumb_dir):
         os.mkdir(common.thumb_dir)
 
+    # thumbnails and image metadata index
+    common.index = Index(os.path.join(common.data_home, "thumbnails.db"))
+    common.pack = Pack(os.path.join(common.data_home, "thumbnails.pack"), common.index)
+    common.writer = Writer(common.pack, common.index)
+
     # command file; let's use separate file name for Hyprland, as generic display names may be different
     if os.getenv("HYPRLAND_INSTANCE_SIGNATURE"):
         common.cmd_file = os.path.join(os.getenv("HOME"), ".azotebg-hyprland")
@@ -422,9 +431,6 @@ def set_env(__version__, lang_from_args=None):
         common.sample_dir = '/usr/share/backgrounds/nwg-shell'
 
     common.settings = Settings()
-    if common.settings.clear_thumbnails:
-        clear_thumbnails(clear_all=True)
-        common.settings.clear_thumbnails = False
 
     # check programs capable of opening files of allowed extensions
     if os.path.isfile('/usr/share/applications/mimeinfo.cache'):
@@ -580,57 +586,109 @@ def copy_backgrounds():
         shutil.copyfile(os.path.join(common.tmp_dir, file), os.path.join(common.bcg_dir, file))
 
 
-def hash_name(full_path):
+def create_thumbnails(scr_path, files=None, on_created=None, on_finished=None, on_draft=None, on_failed=None,
+                      on_reused=None):
     """
-    Thumbnail path -> name (w/o extension)
-    :param full_path: original file path
-    :return: MD5-hashed path
+    Starts creating missing thumbnails in the background, and returns immediately.
+    A task still running for the previously opened folder gets cancelled.
+    :param scr_path: folder to create thumbnails for
+    :param files: list of FileInfo from scan_folder(scr_path), if the caller has it already
+    :param on_created: function(IndexEntry, pixels, width, height) to call in the Gtk main loop when a thumbnail
+                       is ready, with its raw RGB pixels; it may not be stored yet
+    :param on_finished: function to call in the Gtk main loop when all thumbnails are ready
+    :param on_draft: function(path, pixels, width, height) to call in the Gtk main loop with raw RGB pixels of
+                     a preview embedded in the image, to show until its thumbnail is ready
+    :param on_failed: function(Failure) to call in the Gtk main loop when an image could not be decoded
+    :param on_reused: function(IndexEntry) to call in the Gtk main loop when an image got indexed with a thumbnail
+                      we had already, e.g. of a renamed file with content-based keys
+    :return: thumbnailer.Task, e.g. to tell it which thumbnails we need first
     """
-    return hashlib.md5(full_path.encode()).hexdigest()
-
-
-def create_thumbnails(scr_path):
+    if common.thumbnails_task:
+        common.thumbnails_task.cancel()
     common.progress_bar.hide()
-    counter = 0
-    inames = "-iname \"*."+"\" -o -iname \"*.".join(common.allowed_file_types)+"\""
-    files=subprocess.check_output("find '%s' -mindepth 1 %s" %(scr_path, inames), shell=True).decode().split("\n")[:-1]
-    for in_path in files:
-        if file_allowed(in_path):
-            counter += 1
-    if counter > 0:
-        # get all the files of allowed types from current path
+
+    def collect():
+        # We're in the background thread here
+        snapshot = files if files is not None else scan_folder(scr_path, common.allowed_file_types, task.cancelled)
+        return find_thumbnail_jobs(common.writer, scr_path, snapshot, common.thumb_dir, common.settings.master_size,
+                                   common.settings.thumbnail_backend, common.settings.max_decode_pixels,
+                                   common.settings.thumbnail_store, common.settings.thumbnail_keys,
+                                   common.settings.freedesktop_thumbnails, task.cancelled,
+                                   lambda entry: GLib.idle_add(on_thumbnail_reused, task, entry, on_reused))
+
+    task = thumbnailer.Task(collect, thumbnailer.worker_count(common.settings.thumbnail_workers))
+    task.on_result = lambda result, done, total: on_thumbnail_result(task, result, done, total, on_created, on_draft,
+                                                                     on_failed)
+    task.on_finished = lambda cancelled: on_thumbnails_task_end(task, cancelled, on_finished)
+    common.thumbnails_task = task.start()
+    return task
+
+
+def on_thumbnail_result(task, result, done, total, on_created, on_draft, on_failed):
+    # We're in the background thread here
+    if result.draft:
+        # Neither stored nor indexed: the real thumbnail is on its way
+        if on_draft:
+            GLib.idle_add(on_thumbnail_draft, task, result, on_draft)
+        return
+    # The GUI gets the pixels along with the entry, and does not need to wait for them to be stored
+    entry = store_result(common.writer, result)
+    if result.error:
+        if on_failed:
+            GLib.idle_add(on_thumbnail_failed, task, entry, on_failed)
+        entry = None
+    GLib.idle_add(on_thumbnail_created, task, result, entry, done, total, on_created)
+
+
+def on_thumbnails_task_end(task, cancelled, on_finished):
+    # We're in the background thread here
+    common.writer.flush()
+    common.index.flush()
+    GLib.idle_add(on_thumbnails_finished, task, cancelled, on_finished)
+
+
+def on_thumbnail_created(task, result, entry, done, total, on_created):
+    job = result.job
+    action = 'New thumb' if not job.refresh else 'Refresh'
+    if result.error:
+        log('{} - {}'.format(action, result.error), common.ERROR)
+    else:
+        log('{}: {} -> {}'.format(action, job.in_path, os.path.basename(job.dest_path)), common.INFO)
+    # Results of a cancelled task may still be arriving
+    if task is common.thumbnails_task:
         common.progress_bar.show()
-        common.progress_bar.set_fraction(0.0)
-        processed = 0
-        for in_path in files:
-            if file_allowed(in_path):
-                thumb_name = "{}.png".format(hash_name(in_path))
-                dest_path = os.path.join(common.thumb_dir, thumb_name)
-                if not os.path.isfile(dest_path):
-                    create_thumbnail(in_path, dest_path, thumb_name)
-                elif is_newer(in_path, dest_path):
-                    create_thumbnail(in_path, dest_path, thumb_name, True)
-                processed += 1
-                common.progress_bar.set_fraction(processed / counter)
-                common.progress_bar.set_text(str(processed))
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-    common.progress_bar.hide()
+        common.progress_bar.set_fraction(done / total)
+        common.progress_bar.set_text(str(done))
+        if on_created and entry:
+            on_created(entry, result.pixels, job.thumb_size[0], job.thumb_size[1])
+    return False
 
 
-def create_thumbnail(in_path, dest_path, thumb_name, refresh=False):
-    action = 'New thumb' if not refresh else 'Refresh'
-    try:
-        img = Image.open(in_path)
-        # convert to thumbnail image
-        img.thumbnail(common.settings.thumb_size, Image.LANCZOS)
+def on_thumbnail_draft(task, result, on_draft):
+    if task is common.thumbnails_task:
+        on_draft(result.job.in_path, result.pixels, result.job.thumb_size[0], result.job.thumb_size[1])
+    return False
 
-        img = expand_img(img)
 
-        img.save(dest_path, "PNG")
-        log('{}: {} -> {}'.format(action, in_path, thumb_name), common.INFO)
-    except Exception as e:
-        log('{} - {}'.format(action, e), common.ERROR)
+def on_thumbnail_reused(task, entry, on_reused):
+    if task is common.thumbnails_task and on_reused:
+        on_reused(entry)
+    return False
+
+
+def on_thumbnail_failed(task, failure, on_failed):
+    if task is common.thumbnails_task:
+        on_failed(failure)
+    return False
+
+
+def on_thumbnails_finished(task, cancelled, on_finished):
+    if task is common.thumbnails_task:
+        common.thumbnails_task = None
+        common.progress_bar.hide()
+        if on_finished and not cancelled:
+            on_finished()
+    return False
 
 
 def flip_selected_wallpaper():
@@ -645,8 +703,8 @@ def flip_selected_wallpaper():
             img_path = os.path.join(common.bcg_dir, "flipped-{}".format(common.selected_wallpaper.filename))
             flipped.save(os.path.join(common.tmp_dir, "flipped-{}".format(common.selected_wallpaper.filename)), "PNG")
 
-            flipped.thumbnail(common.settings.thumb_size, Image.LANCZOS)
-            flipped = expand_img(flipped)
+            flipped.thumbnail(common.settings.master_size, Image.LANCZOS)
+            flipped = expand_img(flipped, common.settings.master_size)
 
             thumb_path = os.path.join(common.tmp_dir, "thumbnail-{}".format(common.selected_wallpaper.filename))
             flipped.save(thumb_path, "PNG")
@@ -677,11 +735,11 @@ def split_selected_wallpaper(num_parts):
             img_path = os.path.join(common.bcg_dir, "part{}-{}".format(i, common.selected_wallpaper.filename))
             part.save(os.path.join(common.tmp_dir, "part{}-{}".format(i, common.selected_wallpaper.filename)), "PNG")
 
-            part.thumbnail(common.settings.thumb_size, Image.LANCZOS)
+            part.thumbnail(common.settings.master_size, Image.LANCZOS)
 
             thumb_path = os.path.join(common.tmp_dir, "thumb-part{}-{}".format(i, common.selected_wallpaper.filename))
 
-            part = expand_img(part)
+            part = expand_img(part, common.settings.master_size)
 
             part.save(thumb_path, "PNG")
             paths = (img_path, thumb_path)
@@ -692,82 +750,31 @@ def split_selected_wallpaper(num_parts):
         log('Failed splitting {} - {}'.format(common.selected_wallpaper.source_path, e), common.ERROR)
 
 
-def expand_img(image):
-    # We want the thumbnail to be always in the same proportion. Let's expand if necessary.
-    width, height = image.size
-    border_h = (common.settings.thumb_width - width) // 2
-    border_v = (common.settings.thumb_height - height) // 2
-    if border_v > 0 or border_h > 0:
-        # border = (border_h, border_v, border_h, border_v)
-        # return ImageOps.expand(image, border=border)
-        # Let's add checkered background instead of the black one
-        background = Image.open(os.path.join(dir_name, 'images/squares.jpg'))
-        background = background.resize(common.settings.thumb_size, Image.LANCZOS)
-        background.paste(image, (border_h, border_v))
-        return background
-    else:
-        return image
-
-
 def scale_and_crop(item, image_path, width, height):
-    img = Image.open(image_path)
-
-    # We can either scale vertically & crop horizontally or scale horizontally and crop vertically
-    new_height = int(img.size[0] * height / width)
-
-    if new_height < img.size[1]:  # we need to scale to display width and crop vertical margins
-        new_height = int(width * img.size[1] / img.size[0])
-        # Choose the filter depending on if we're scaling down or up
-        if new_height >= height:
-            img = img.resize((width, new_height), Image.LANCZOS)
-        else:
-            img = img.resize((width, new_height), Image.BILINEAR)
-
-        margin = (img.size[1] - height) // 2
-        img = img.crop((0, margin, width, height + margin))
-
-    elif new_height > img.size[1]:  # we need to scale to display height and crop horizontal margins
-        new_width = int(img.size[0] * height / img.size[1])
-        if new_width >= width:
-            img = img.resize((new_width, height), Image.LANCZOS)
-        else:
-            img = img.resize((new_width, height), Image.BILINEAR)
-
-        margin = (img.size[0] - width) // 2
-        img = img.crop((margin, 0, width + margin, height))
-
-    else:
-        img = img.resize((width, height), Image.LANCZOS)
-
-    img.save('{}-{}x{}{}'.format(os.path.splitext(image_path)[0], width, height, os.path.splitext(image_path)[1]))
-    common.preview.refresh()
-
-
-def is_newer(in_path, dest_path):
-    return os.path.getmtime(in_path) > os.path.getmtime(dest_path)
-
-
-def file_allowed(path):
-    ext = path.split('.')[-1].lower()
-    return ext in common.allowed_file_types
+    path = imaging.scale_and_crop(image_path, width, height)
+    common.preview.update([path])
 
 
 def update_status_bar():
-    num_files = 0
-    total_size = 0
-    if os.path.isdir(common.thumb_dir):
-        for file in os.listdir(common.thumb_dir):
-            num_files += 1
-            file_info = os.stat(os.path.join(common.thumb_dir, file))
-            total_size += file_info.st_size
+    num_files, total_size = common.index.stats()
     common.status_bar.push(0, common.lang['thumbnails_in_cache'].format(num_files, convert_bytes(total_size)))
 
 
 def clear_thumbnails(clear_all=False):
-    files_in_use = os.listdir(common.settings.src_path)
-    for i in range(len(files_in_use)):
-        full_path = os.path.join(common.settings.src_path, files_in_use[i])
-        files_in_use[i] = '{}.png'.format(hashlib.md5(full_path.encode()).hexdigest())
+    common.writer.flush()
+    if clear_all:
+        common.index.clear()
+        common.pack.clear()
+        files_in_use = []
+    else:
+        files_in_use = os.listdir(common.settings.src_path)
+        for i in range(len(files_in_use)):
+            full_path = os.path.join(common.settings.src_path, files_in_use[i])
+            files_in_use[i] = '{}.png'.format(hashlib.md5(full_path.encode()).hexdigest())
+        # Thumbnails of files in subfolders, and of files not yet indexed, are also in use
+        keys_in_use = common.index.retain(common.settings.src_path)
+        files_in_use = set(files_in_use) | set('{}.png'.format(key) for key in keys_in_use)
+        common.pack.compact(keep=keys_in_use)
 
     number = 0
     for file in os.listdir(common.thumb_dir):
@@ -801,6 +808,16 @@ def create_pixbuf(size, color):
     return GdkPixbuf.Pixbuf.new_from_bytes(data, GdkPixbuf.Colorspace.RGB, False, 8, w, h, w * 3)
 
 
+def display_scale():
+    """
+    :return: the biggest scale factor of connected monitors: 2 with HiDPI scaling on, 1 otherwise
+    """
+    display = Gdk.Display.get_default()
+    if display is None:
+        return 1
+    return max([display.get_monitor(i).get_scale_factor() for i in range(display.get_n_monitors())] or [1])
+
+
 class Settings(object):
     def __init__(self):
         # Settings available in GUI we'll store in a pickle file
@@ -811,7 +828,7 @@ class Settings(object):
         # Gtk.Menu() on sway is unreliable, especially called with right click
         self.custom_display = None
         self.old_thumb_width = None
-        self.clear_thumbnails = False
+        self.master_width = None
         self.copy_as = '#rgb'
         self.color_dictionary = False
         self.image_menu_button = False
@@ -861,6 +878,13 @@ class Settings(object):
         except AttributeError:
             save_needed = True
 
+        try:
+            self.master_width = settings.master_width
+        except AttributeError:
+            # Thumbnails created by previous versions are as wide as they were displayed
+            self.master_width = self.old_thumb_width
+            save_needed = True
+
         try:
             self.copy_as = settings.copy_as
         except AttributeError:
@@ -891,8 +915,24 @@ class Settings(object):
         if self.old_thumb_width != self.thumb_width:
             self.old_thumb_width = self.thumb_width
             save_needed = True
-            log('New thumbnail width: {}, clearing existing thumbnails!'.format(self.thumb_width), common.WARNING)
-            self.clear_thumbnails = True
+            log('New thumbnail width: {}'.format(self.thumb_width), common.INFO)
+
+        # Thumbnails are created at the master width, and scaled to the thumbnail width (times the display scale)
+        # when shown. By default there's room for a HiDPI display, or a bigger thumbnail width. Thumbnails created
+        # for a smaller master get created again as their folders get opened, and are shown upscaled until then.
+        self.display_scale = display_scale()
+        if self.thumbnail_master_width:
+            master_width = max(self.thumbnail_master_width, self.thumb_width * self.display_scale)
+        else:
+            master_width = max(self.master_width or 0, self.thumb_width * max(2, self.display_scale))
+        if master_width != self.master_width:
+            if self.master_width:
+                log('New thumbnail master width: {}, smaller thumbnails will be created again'.format(master_width),
+                    common.WARNING)
+            self.master_width = master_width
+            save_needed = True
+        self.master_size = (self.master_width, int(self.master_width * 135 / 240))
+        log('Thumbnail master size: {}, display scale: {}'.format(self.master_size, self.display_scale), common.INFO)
 
         if save_needed:
             self.save()
@@ -930,6 +970,12 @@ class Settings(object):
         self.thumb_size = (self.thumb_width, self.thumb_height)
         log('Thumbnail size: {}'.format(self.thumb_size), common.INFO)
 
+        try:
+            self.thumbnail_master_width = int(rc['thumbnail_master_width'])
+        except KeyError:
+            self.thumbnail_master_width = 0
+            save_needed = True
+
         try:
             self.columns = int(rc['columns'])
         except KeyError:
@@ -979,6 +1025,71 @@ class Settings(object):
         log('Screen measurement delay: {} ms'.format(self.screen_measurement_delay),
             common.INFO)
 
+        try:
+            self.thumbnail_workers = int(rc['thumbnail_workers'])
+            if self.thumbnail_workers < 0:
+                self.thumbnail_workers = 0
+        except KeyError:
+            self.thumbnail_workers = 0
+            save_needed = True
+        log('Thumbnail workers: {} (0 = number of CPU cores)'.format(self.thumbnail_workers), common.INFO)
+
+        try:
+            self.thumbnail_backend = rc['thumbnail_backend']
+            if self.thumbnail_backend != 'auto' and self.thumbnail_backend not in backends.BACKENDS:
+                log('Unknown thumbnail backend: {}, using auto'.format(self.thumbnail_backend), common.WARNING)
+                self.thumbnail_backend = 'auto'
+        except KeyError:
+            self.thumbnail_backend = 'auto'
+            save_needed = True
+        log('Thumbnail backend: {} (available: {})'.format(self.thumbnail_backend, ', '.join(backends.available())),
+            common.INFO)
+
+        try:
+            self.max_decode_pixels = int(rc['max_decode_pixels'])
+        except KeyError:
+            self.max_decode_pixels = 50000000
+            save_needed = True
+        log('Max decode pixels: {} (bigger images are reduced in strips)'.format(self.max_decode_pixels), common.INFO)
+
+        try:
+            self.thumbnail_cache_mb = int(rc['thumbnail_cache_mb'])
+        except KeyError:
+            self.thumbnail_cache_mb = 64
+            save_needed = True
+        log('Thumbnail cache: {} MB'.format(self.thumbnail_cache_mb), common.INFO)
+
+        try:
+            self.thumbnail_store = rc['thumbnail_store']
+            if self.thumbnail_store not in ('pack', 'png'):
+                log('Unknown thumbnail store: {}, using pack'.format(self.thumbnail_store), common.WARNING)
+                self.thumbnail_store = 'pack'
+        except KeyError:
+            self.thumbnail_store = 'pack'
+            save_needed = True
+        log('Thumbnail store: {}'.format(self.thumbnail_store), common.INFO)
+
+        try:
+            self.thumbnail_keys = rc['thumbnail_keys']
+            if self.thumbnail_keys not in ('path', 'content'):
+                log('Unknown thumbnail keys: {}, using path'.format(self.thumbnail_keys), common.WARNING)
+                self.thumbnail_keys = 'path'
+        except KeyError:
+            self.thumbnail_keys = 'path'
+            save_needed = True
+        log('Thumbnail keys: {}'.format(self.thumbnail_keys), common.INFO)
+
+        try:
+            self.freedesktop_thumbnails = rc['freedesktop_thumbnails']
+            if self.freedesktop_thumbnails not in ('off', 'read', 'write'):
+                log('Unknown freedesktop thumbnails mode: {}, using read'.format(self.freedesktop_thumbnails),
+                    common.WARNING)
+                self.freedesktop_thumbnails = 'read'
+        except KeyError:
+            self.freedesktop_thumbnails = 'read'
+            save_needed = True
+        log('Freedesktop thumbnails: {}'.format(self.freedesktop_thumbnails), common.INFO)
+
         if save_needed:
             self.save_rc()
 
@@ -992,6 +1103,14 @@ class Settings(object):
             self.palette_quality = 10
             self.tracking_interval_seconds = 5
             self.screen_measurement_delay = 300
+            self.thumbnail_workers = 0
+            self.thumbnail_backend = 'auto'
+            self.max_decode_pixels = 50000000
+            self.thumbnail_cache_mb = 64
+            self.thumbnail_store = 'pack'
+            self.thumbnail_keys = 'path'
+            self.freedesktop_thumbnails = 'read'
+            self.thumbnail_master_width = 0
 
         rc = {'thumb_width': str(self.thumb_width),
               'columns': str(self.columns),
@@ -1000,7 +1119,15 @@ class Settings(object):
               'clip_prev_size': str(self.clip_prev_size),
               'palette_quality': str(self.palette_quality),
               'tracking_interval_seconds': str(self.tracking_interval_seconds),
-              'screen_measurement_delay': str(self.screen_measurement_delay)}
+              'screen_measurement_delay': str(self.screen_measurement_delay),
+              'thumbnail_workers': str(self.thumbnail_workers),
+              'thumbnail_backend': self.thumbnail_backend,
+              'max_decode_pixels': str(self.max_decode_pixels),
+              'thumbnail_cache_mb': str(self.thumbnail_cache_mb),
+              'thumbnail_store': self.thumbnail_store,
+              'thumbnail_keys': self.thumbnail_keys,
+              'freedesktop_thumbnails': self.freedesktop_thumbnails,
+              'thumbnail_master_width': str(self.thumbnail_master_width)}
 
         with open(self.rc_file, 'w') as f:
             json.dump(rc, f, indent=2)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""
+Watches the wallpapers folder with inotify, instead of checking it periodically
+
+Author: Piotr Miller & Contributors
+e-mail: nwg.piotr@gmail.com
+Project: https://github.com/nwg-piotr/azote
+License: GPL3
+
+The inotify file descriptor is watched by the GLib main loop, so we cost nothing while nothing happens.
+Linux only: on other systems Watcher() raises OSError, and the caller needs to fall back to polling.
+"""
+import os
+import errno
+import ctypes
+import ctypes.util
+import struct
+
+from gi.repository import GLib
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# We don't care for modifications in progress: IN_CLOSE_WRITE tells us when the file is complete
+MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | \
+    IN_ONLYDIR
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def libc():
+    global _libc
+    if _libc is None:
+        lib = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(lib, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not supported')
+        lib.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        lib.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = lib
+    return _libc
+
+
+class Watcher(object):
+    def __init__(self, on_change, extensions, delay=200):
+        """
+        :param on_change: function(set of paths) called in the Gtk main loop, `delay` ms after the first change
+        :param extensions: file extensions we care for, lowercase; changes to subfolders are always reported
+        :param delay: ms; copying a bunch of files should result in a single call
+        """
+        self.on_change = on_change
+        self.extensions = extensions
+        self.delay = delay
+        self.root = None
+        self.watches = {}       # watch descriptor: folder
+        self.changed = set()
+        self.timer = None
+
+        self.fd = libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.source = GLib.io_add_watch(self.fd, GLib.PRIORITY_DEFAULT, GLib.IOCondition.IN, self.on_readable)
+
+    def watch(self, root):
+        """
+        Follows the folder and all its subfolders; stops following the previous one
+        """
+        if root == self.root:
+            return
+        for wd in list(self.watches):
+            libc().inotify_rm_watch(self.fd, wd)
+        self.watches = {}
+        self.changed = set()
+        self.root = root
+        self.add_tree(root)
+
+    def add_tree(self, folder):
+        for path, dirs, files in os.walk(folder):
+            wd = libc().inotify_add_watch(self.fd, os.fsencode(path), MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e == errno.ENOSPC:
+                    # fs.inotify.max_user_watches exhausted: no point trying further
+                    raise OSError(e, 'inotify watch limit reached')
+                continue
+            self.watches[wd] = path
+
+    def remove_tree(self, folder):
+        prefix = os.path.join(folder, '')
+        for wd, path in list(self.watches.items()):
+            if path == folder or path.startswith(prefix):
+                libc().inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def on_readable(self, fd, condition):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+                offset += EVENT.size + length
+                self.on_event(wd, mask, os.fsdecode(name))
+        return True
+
+    def on_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # We've lost events: only the whole folder will do
+            self.notify(self.root)
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        folder = self.watches.get(wd)
+        if folder is None:
+            return
+        path = os.path.join(folder, name) if name else folder
+        if mask & IN_ISDIR or not name:
+            if mask & IN_MOVED_FROM:
+                # Watches follow the inode: the moved folder will be watched again under its new name, if still ours
+                self.remove_tree(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self.add_tree(path)
+                except OSError:
+                    pass
+            self.notify(path)
+        elif not mask & IN_CREATE and name.split('.')[-1].lower() in self.extensions:
+            # New files get reported once written (IN_CLOSE_WRITE)
+            self.notify(path)
+
+    def notify(self, path):
+        self.changed.add(path)
+        if not self.timer:
+            self.timer = GLib.timeout_add(self.delay, self.on_timeout)
+
+    def on_timeout(self):
+        self.timer = None
+        changed, self.changed = self.changed, set()
+        if changed:
+            self.on_change(changed)
+        return False
+
+    def close(self):
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        GLib.source_remove(self.source)
+        os.close(self.fd)
@@ -24,7 +24,7 @@ setup(
     install_requires=[],
     entry_points={
         'gui_scripts': [
-            'azote = azote.main:main'
+            'azote = azote.launcher:main'
         ]
     }
 )